@@ -0,0 +1,17 @@
+#!python
+#-*- coding: utf-8 -*-
+"""
+    Entry point of 'python -m hformat' when run from the repository root,
+    where 'hformat' is this directory instead of the main module (see
+    'cli.py').
+"""
+import os
+import sys
+
+# The modules import each other by their plain names, so this directory goes
+# first in the path, and 'hformat' must be the main module, not the package.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.modules.pop('hformat', None)
+from cli import main
+
+sys.exit(main())
@@ -0,0 +1,58 @@
+#!python
+#-*- coding: utf-8 -*-
+"""
+    Asynchronous Formatting for Human Formatter
+
+    This module formats templates under asyncio, for expressions whose values
+    are awaitables (such as calls to coroutine functions). It is only imported
+    by 'Template.format_async()', so the rest of the Human Formatter keeps
+    working with any Python version.
+
+    Fields are converted level by level, deepest first, as always. All the
+    expressions of a level are evaluated, and then their awaitable values are
+    awaited at the same time, with an optional limit of how many at once.
+
+    Functions
+    ---------
+    format_async() -> str
+        Coroutine. Formats a template with the given arguments.
+
+
+    Created:        18 Oct 2026
+    Last modified:  18 Oct 2026
+"""
+import asyncio
+import inspect
+
+
+#
+# Functions
+#
+async def format_async (template, limit, args, kwargs):
+    """Returns *template* formatted, awaiting the awaitable field values."""
+    hf = template._formatter(args, kwargs)
+    semaphore = asyncio.Semaphore(limit) if limit else None
+    conversions = [None] * len(template._fields)
+    for level in template._levels():
+        parsed, jobs = template._level_jobs(hf, level, conversions)
+        results = [template._evaluate_job(hf, e) for e in jobs.values()]
+        pending = [i for i, (value, error) in enumerate(results)
+                   if inspect.isawaitable(value)]
+        values = await asyncio.gather(*[_await(results[i][0], semaphore)
+                                        for i in pending])
+        for i, result in zip(pending, values):
+            results[i] = result
+        template._level_conversions(hf, level, parsed,
+                                    dict(zip(jobs, results)), conversions)
+    return template._output(conversions)
+
+
+async def _await (awaitable, semaphore):
+    """Awaits *awaitable*, returning a tuple (value, error)."""
+    try:
+        if semaphore is None:
+            return (await awaitable, None)
+        async with semaphore:
+            return (await awaitable, None)
+    except Exception as err:
+        return (None, err)
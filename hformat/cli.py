@@ -0,0 +1,282 @@
+#!python
+#-*- coding: utf-8 -*-
+"""
+    Command Line Interface for Human Formatter
+
+    This module allows to use the Human Formatter from the shell, formatting
+    streams of records with a template. Each record (a CSV or TSV row, or a
+    JSON Lines line) gives the arguments for one formatting, and the outputs
+    are written in the same order as the records were read.
+
+        python -m hformat "{name : width(10)} {total : float(2)}" data.csv
+
+    CSV and TSV rows are given as keyword arguments, named after the header
+    row (or as positional arguments with '--no-header'). JSON objects are
+    given as keyword arguments, JSON arrays as positional ones, and any other
+    JSON value as the only positional argument.
+
+    Records are read and written in chunks, and with '--jobs' those chunks
+    are formatted by a pool of processes.
+
+    Unlike the rest of the package, the command line needs Python 3.
+
+    Functions
+    ---------
+    main() -> int
+        Entry point. Parses the command line arguments, formats every record
+        and returns the exit status.
+
+    Created:        18 Oct 2026
+    Last modified:  18 Oct 2026
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from itertools import islice
+
+from hformat import hfcompile
+
+
+#
+# Definitions
+#
+_FORMATS = ('csv', 'tsv', 'jsonl')
+_EXTENSIONS = {'.csv': 'csv', '.tsv': 'tsv', '.jsonl': 'jsonl',
+               '.ndjson': 'jsonl', '.json': 'jsonl'}
+DEFAULT_CHUNK_SIZE = 10000
+_BUFFER_SIZE = 1 << 20
+
+
+#
+# Errors
+#
+ERR_RECORD = "hformat: record {0} in {1!r}: {2}"
+ERR_TEMPLATE = "hformat: template {0!r}: {1}"
+ERR_INPUT = "hformat: {0!r}: {1}"
+ERR_PYTHON = "hformat: the command line needs Python 3"
+
+
+#
+# Functions
+#
+def main (argv=None):
+    """Entry point of 'python -m hformat'. Returns the exit status."""
+    if sys.version_info[0] < 3:
+        sys.stderr.write(ERR_PYTHON + '\n')
+        return 2
+    options = _parse_args(argv)
+    if options.template_file:
+        try:
+            with io.open(options.template_file,
+                         encoding=options.encoding) as tf:
+                template = tf.read().rstrip('\n')
+        except (OSError, UnicodeDecodeError) as err:
+            sys.stderr.write(ERR_INPUT.format(options.template_file,
+                                              _reason(err)) + '\n')
+            return 2
+    else:
+        template = options.template
+
+    # Compiled here first, so a wrong template is reported just once.
+    try:
+        _init_worker(template, options.end, options.numbers)
+    except Exception as err:
+        sys.stderr.write(ERR_TEMPLATE.format(template, "{}: {}".format(
+                                             type(err).__name__, err)) + '\n')
+        return 2
+
+    out = io.open(sys.stdout.fileno(), 'w', encoding=options.encoding,
+                  buffering=_BUFFER_SIZE, closefd=False)
+    pool = None
+    if options.jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(options.jobs, _init_worker,
+                                    (template, options.end, options.numbers))
+
+    status = 0
+    try:
+        for path in options.files or ['-']:
+            fmt = options.format or _guess_format(path)
+            try:
+                status = _format_file(path, fmt, options, out, pool)
+            except (OSError, UnicodeDecodeError, csv.Error) as err:
+                sys.stderr.write(ERR_INPUT.format(path, _reason(err)) + '\n')
+                status = 2
+            if status:
+                break
+    finally:
+        out.flush()
+        if pool is not None:
+            pool.terminate()
+    return status
+
+
+def _parse_args (argv):
+    """Returns the parsed command line arguments."""
+    parser = argparse.ArgumentParser(prog='hformat',
+        description="Formats each record of CSV, TSV or JSON Lines streams"
+                    " with a Human Formatter template.")
+    parser.add_argument('template', nargs='?',
+                        help="template string (unless -t is given)")
+    parser.add_argument('files', nargs='*',
+                        help="input files ('-' or none for stdin)")
+    parser.add_argument('-t', '--template-file',
+                        help="read the template from this file")
+    parser.add_argument('-F', '--format', choices=_FORMATS,
+                        help="input format (by default, from the extension,"
+                             " or csv)")
+    parser.add_argument('-n', '--no-header', action='store_true',
+                        help="CSV/TSV rows are positional arguments")
+    parser.add_argument('-N', '--numbers', action='store_true',
+                        help="give CSV/TSV numeric values as int or float")
+    parser.add_argument('-e', '--end', default='\n',
+                        help="string written after each record")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of formatting processes")
+    parser.add_argument('-c', '--chunk-size', type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help="records formatted at once")
+    parser.add_argument('--encoding', default='utf-8',
+                        help="encoding of the input and output")
+    # Options may come after the positional arguments (Python 3.7+).
+    options = getattr(parser, 'parse_intermixed_args',
+                      parser.parse_args)(argv)
+    if options.jobs < 1:
+        parser.error("--jobs must be 1 or more")
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be 1 or more")
+    if options.template_file:
+        if options.template is not None:
+            options.files.insert(0, options.template)
+    elif options.template is None:
+        parser.error("a template, or a template file, is needed")
+    return options
+
+
+def _format_file (path, fmt, options, out, pool):
+    """Formats every record of the input *path* into *out*.
+
+    Returns the exit status: 1 if a record could not be formatted. Errors
+    opening or reading the input are raised.
+
+    """
+    with _open_input(path, options.encoding) as stream:
+        chunks = _read_chunks(stream, fmt, options)
+        if pool is None:
+            results = map(_format_chunk, chunks)
+        else:
+            # 'imap' keeps the order of the chunks.
+            results = pool.imap(_format_chunk, chunks)
+        for output, error in results:
+            out.write(output)
+            if error:
+                index, message = error
+                sys.stderr.write(ERR_RECORD.format(index, path, message)
+                                 + '\n')
+                return 1
+    return 0
+
+
+def _reason (err):
+    """Returns the message of an input error, without its errno."""
+    return getattr(err, 'strerror', None) or str(err)
+
+
+def _guess_format (path):
+    """Returns the input format from the file extension, or 'csv'."""
+    for extension, fmt in _EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return fmt
+    return 'csv'
+
+
+def _open_input (path, encoding):
+    """Returns the input text stream of *path* ('-' for stdin)."""
+    if path == '-':
+        return io.open(sys.stdin.fileno(), encoding=encoding, newline='',
+                       buffering=_BUFFER_SIZE, closefd=False)
+    return io.open(path, encoding=encoding, newline='',
+                   buffering=_BUFFER_SIZE)
+
+
+def _read_chunks (stream, fmt, options):
+    """Yields chunks of (record_index, kind, record) tuples from the input.
+
+    CSV and TSV records are rows already split. JSON Lines records are the
+    raw lines, decoded by the formatting process.
+
+    """
+    if fmt == 'jsonl':
+        records = (('json', line) for line in stream if line.strip())
+    else:
+        reader = csv.reader(stream, delimiter='\t' if fmt == 'tsv' else ',')
+        header = None if options.no_header else next(reader, None)
+        if header is None:
+            records = (('args', row) for row in reader)
+        else:
+            records = (('kwargs', dict(zip(header, row))) for row in reader)
+    records = enumerate(records, 1)
+    while True:
+        chunk = list(islice(records, options.chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+_template = None
+_end = None
+_numbers = False
+
+def _init_worker (template, end, numbers):
+    """Compiles the template in the formatting process."""
+    global _template, _end, _numbers
+    _template = hfcompile(template)
+    _end = end
+    _numbers = numbers
+
+
+def _number (value):
+    """Returns the CSV value as an int or a float, if it is a number."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _format_chunk (chunk):
+    """Formats a chunk of records.
+
+    Returns a tuple (output, error). The output has every record formatted
+    before the first failing one, whose (index, message) is the error.
+
+    """
+    parts = list()
+    for index, (kind, record) in chunk:
+        try:
+            if kind == 'json':
+                record = json.loads(record)
+                if isinstance(record, dict):
+                    kind = 'kwargs'
+                elif isinstance(record, list):
+                    kind = 'args'
+                else:
+                    kind, record = 'args', [record]
+            elif _numbers:
+                if kind == 'kwargs':
+                    record = dict((k, _number(v)) for k, v in record.items())
+                else:
+                    record = [_number(v) for v in record]
+            if kind == 'kwargs':
+                parts.append(_template.format(**record))
+            else:
+                parts.append(_template.format(*record))
+        except Exception as err:
+            return ''.join(parts), (index, "{}: {}".format(type(err).__name__,
+                                                           err))
+        parts.append(_end)
+    return ''.join(parts), None
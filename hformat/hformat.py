@@ -36,12 +36,58 @@
     hfprint() -> str
         Same as 'hformat()', but prints the string before returning it.
 
+    hformat_bytes() -> bytes
+        Same as 'hformat()', but returns the result encoded, with the fields
+        widths measured in encoded bytes.
+
+    iformat() -> generator
+        Same as 'hformat()', but yields the result in pieces, as soon as each
+        one is formatted.
+
+    hfcompile() -> Template
+        Compiles a hformatted string once, so it can be formatted many times.
+
+    lazy() -> Lazy
+        Wraps a function, so its result is only computed if it is used.
+
+    register_function() -> None
+        Adds a custom function to the specs language.
+
+    explain() -> list
+        Reports how each field of a template is formatted, and optionally how
+        long it takes.
+
+    save_cache() -> int
+        Saves the compiled templates into a cache file.
+
+    preload_cache() -> int
+        Loads the templates from a cache file, so they need no compiling.
+
     Classes
     -------
     HumanFormatter
         Main engine for the Human Formatter. Does all the format, parse and
         conversion. Based on Python's str.Formatter.
 
+    Lazy
+        Argument whose value is computed on its first reference.
+
+    FieldSpec
+        Interpretation of the functions of a field, made once so it can be
+        applied to many values.
+
+    Template
+        Compiled hformatted string. Keeps the tokens and the parsed fields, so
+        every new formatting only needs to convert them.
+
+    BoundTemplate
+        Stateful Template, that keeps the last conversion of each field and
+        only converts again the fields whose values changed.
+
+    ResultMemo
+        Bounded cache of the conversions of a template field, keyed by the
+        evaluated value and the field functions.
+
     FunctionObject
         Dataclass that stores info about the Human Formatter functions in the
         given string, so its handling is easier. It also checks for syntax and
@@ -58,25 +104,116 @@
         + [Prop] Allow to use locals and globals optionally.
 
 """
+import ast
+import copy
+import hashlib
+import math
+import os
+import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
 if sys.version_info[0] < 3:
     from itertools import izip_longest as zip_longest
 else:
     from itertools import zip_longest
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+try:
+    from enum import Enum
+except ImportError:
+    Enum = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import yaml
 
 from placeholder import PlaceholderHandler
-from tokenizer import Token
+from tokenizer import Token, ERR_MISSING_OPENING_KEY
+from widths import display_width as _display_width
 
 
 #
 # Definitions
 #
-_FDEFS_FILE = "functions.yml"
+_FDEFS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "functions.yml")
 _CANVAS_FILL_PLACEHOLDER = chr(5)
 _MISC_PLACEHOLDER = chr(6)
 _MULTICHAR_FILL_PLACEHOLDER = chr(7)
+_HOLE_PLACEHOLDER = chr(8)
+_HOLE_REGEX = re.compile(_HOLE_PLACEHOLDER + r'(\d+)' + _HOLE_PLACEHOLDER)
+# Nested conversions with any of these could change how the parent is parsed.
+_UNSAFE_HOLE_REGEX = re.compile(r'[,;:()\'"!{}]|^\s|\s$')
+# Expressions with any of these may read positional arguments.
+_POSITIONAL_REGEX = re.compile(r'\d[.\[]|_\d+_')
+_WORD_REGEX = re.compile(r'\S+')     # Words reflowed by 'reflow'.
 ESCAPE_CHAR = '!'
+_MISSING = object()     # Value of the names not given as arguments.
+_COMPILED = OrderedDict()   # Templates compiled or preloaded, oldest first.
+_COMPILED_LIMIT = 1000
+_CUSTOM_FUNCTIONS = dict()  # Implementations of the registered functions.
+# Presentation types of the casting functions, in order of preference.
+_PTYPES = OrderedDict([
+    ('string', ''),
+    ('bin', 'b'),
+    ('rawbin', 'b'),
+    ('char', 'c'),
+    ('decimal', 'd'),
+    ('octal', 'o'),
+    ('rawoctal', 'o'),
+    ('hex', 'x'),
+    ('Hex', 'X'),
+    ('rawhex', 'x'),
+    ('rawHex', 'X'),
+    ('number', 'n'),
+    ('exp', 'e'),
+    ('Exp', 'E'),
+    ('float', 'f'),
+    ('Float', 'F'),
+    ('general', 'g'),
+    ('General', 'G'),
+    ('percentage', '%'),
+])
+_CODES = dict()         # Compiled expressions, by their translated text.
+_CODES_LIMIT = 10000
+_NAMES = dict()         # Names read by each expression, by its text.
+# Globals of the evaluated expressions: only the builtins, so the names of this
+# module never change what a template outputs.
+_EVAL_GLOBALS = {'__builtins__': builtins}
+_KEYS_REGEX = re.compile(r'[{}]')
+# After the opening key, a field with an empty expression.
+_AUTO_REGEX = re.compile(r'\}|\s*:')
+_PLAIN_REGEX = re.compile(r'^\s*[A-Za-z_]\w*\s*$')
+_timer = getattr(time, 'perf_counter', time.time)
+# Thread pools of 'format_concurrent()', by process and number of threads, so
+# they are created once instead of on every formatting.
+_THREAD_POOLS = dict()
+_THREAD_POOLS_LOCK = threading.Lock()
+_pool_thread = threading.local()    # Tells the threads of those pools apart.
+# Specs interned across templates: the FunctionObjects by the specs text, and
+# the FieldSpecs by the functions key.
+_SPEC_FUNCTIONS = dict()
+_FIELD_SPECS = dict()
+_SPECS_LIMIT = 10000
+# Immutable types whose values can be memoized (see 'ResultMemo').
+if sys.version_info[0] < 3:
+    _MEMO_TYPES = (int, long, float, bool, str, unicode, type(None))
+else:
+    _MEMO_TYPES = (int, float, bool, str, bytes, type(None))
+# Types that 'trim' formats only partially: text is sliced before formatting,
+# and containers reprs are built only up to the limit (see '_bounded_repr()').
+if sys.version_info[0] < 3:
+    _TEXT_TYPES = (str, unicode)
+    _CONTAINER_TYPES = ()   # Python 2 reprs are not rebuilt.
+else:
+    _TEXT_TYPES = (str,)
+    _CONTAINER_TYPES = (list, tuple, dict, set, frozenset)
 
 
 #
@@ -85,6 +222,12 @@ ESCAPE_CHAR = '!'
 ERR_FUNC_DOESNT_EXIST = "HFormat Error: Function {!r} is not defined."
 ERR_TOO_MANY_ARGS = "HFormat Error: {0!r} takes {1} args, but {2} were given."
 ERR_TOO_FEW_ARGS = "HFormat Error: {0!r} expects {1} args, but {2} were given."
+ERR_FUNC_ALREADY_DEFINED = "HFormat Error: Function {!r} is already defined."
+ERR_BAD_ARG_DEF = "HFormat Error: Argument definition {!r} is not like"\
+                  " 'name, man' or 'name, opt'."
+ERR_NO_ENCODING = "HFormat Error: Template {!r} has no encoding set."
+ERR_BUFFER_TOO_SMALL = "HFormat Error: Buffer of {0} bytes is too small, {1}"\
+                       " bytes are needed from offset {2}."
 
 
 #
@@ -106,6 +249,554 @@ def hfprint (string, *args, **kwargs):
     print(result)
     return result
 
+def hformat_bytes (format_string__, *args, **kwargs):
+    """Same as *hformat*, but returns the result as encoded bytes.
+
+    The encoding can be set with the keyword 'encoding__' (UTF-8 by default).
+    Fields widths are measured in encoded bytes instead of chars.
+
+    """
+    encoding = kwargs.pop('encoding__', 'utf-8')
+    hf = HumanFormatter(encoding)
+    return hf.format(format_string__, *args, **kwargs)
+
+def iformat (format_string__, *args, **kwargs):
+    """Same as *hformat*, but yields the result in pieces, in order.
+
+    The string is only scanned for its keys at first. Each top-level field
+    is then compiled and formatted when the output reaches it, and forgotten
+    once yielded; so the first pieces are yielded right away, and only one
+    field is kept compiled at a time. Just like 'Template.iformat()',
+    expressions are evaluated in the output order.
+
+    """
+    spans, autos = _scan_fields(format_string__)
+    hf = HumanFormatter()
+    hf.given_args = _arguments(kwargs)
+    hf.given_args['__args__'] = args
+    position = 0
+    for start, end in spans:
+        if start > position:
+            yield format_string__[position:start]
+        # Empty expressions get the number they have in the whole string.
+        field = format_string__[start:end]
+        for auto in sorted([a for a in autos if start <= a < end],
+                           reverse=True):
+            field = field[:auto-start+1] + '_{}_'.format(autos[auto]) \
+                    + field[auto-start+1:]
+        template = Template(field, share_expressions=False)
+        conversion = template._output(template._convert_with(hf))
+        if conversion:
+            yield conversion
+        position = end
+    if position < len(format_string__):
+        yield format_string__[position:]
+
+def _scan_fields (string):
+    """Finds the top-level fields of *string*, just as 'Token' does.
+
+    Returns a tuple (spans, autos): the (start, end) positions of each field
+    (keys included), and a dict with the number of each empty expression by
+    the position of its field, numbered in the conversion order (deepest
+    levels first).
+
+    A closing key with no opening one raises the same error as in 'Token'.
+
+    """
+    spans = list()
+    found = list()      # (level, position) of the empty expressions.
+    pending = list()    # The same, inside a field not closed yet.
+    stack = list()
+    for match in _KEYS_REGEX.finditer(string):
+        index = match.start()
+        if match.group() == '{':
+            stack.append(index)
+        elif stack:
+            start = stack.pop()
+            if _AUTO_REGEX.match(string, start + 1):
+                pending.append((len(stack) + 1, start))
+            if not stack:
+                spans.append((start, index + 1))
+                found.extend(pending)
+                pending = list()
+        else:
+            raise SyntaxError(ERR_MISSING_OPENING_KEY.format(index))
+    found.sort(key=lambda auto: (-auto[0], auto[1]))
+    autos = dict((position, number)
+                 for number, (level, position) in enumerate(found))
+    return spans, autos
+
+def hfcompile (format_string, encoding=None, memo_size=0, display_width=False,
+               share_expressions=True):
+    """Compiles the given string into a reusable *Template*.
+
+    If *encoding* is given, the template will output encoded bytes. If
+    *memo_size* is given, each field memoizes up to that many conversions.
+    If *display_width* is True, widths are measured in terminal cells. If
+    *share_expressions* is False, repeated expressions are evaluated again
+    in every field (needed if they have side effects).
+    The last templates compiled (up to '_COMPILED_LIMIT') are kept, so
+    compiling the same string again returns the same template.
+
+    """
+    key = (format_string, encoding, memo_size, display_width,
+           share_expressions)
+    template = _COMPILED.get(key)
+    if template is None:
+        while len(_COMPILED) >= _COMPILED_LIMIT:
+            _COMPILED.popitem(last=False)
+        template = _COMPILED[key] = Template(*key)
+    return template
+
+def lazy (function):
+    """Returns a *Lazy* argument, whose value is computed by *function*."""
+    return Lazy(function)
+
+def register_function (names, scalar, args=(), batch=None):
+    """Registers a custom function, so it can be used in the specs.
+
+    *names* are the function name and its aliases, as a list or as a comma
+    separated string; and *args* is the list of its arguments definitions,
+    such as 'symbol, opt' (both in the same way as in 'functions.yml').
+
+    *scalar* is called with the field value and the arguments given in the
+    specs, and returns a new value, which is then formatted by the rest of
+    functions. *batch*, optional, is called with a list of values instead,
+    and returns the list of new values ('Template.format_many()' uses it).
+
+    Custom functions are resolved when the field is compiled, so templates
+    compiled before registering a function again keep the previous one.
+
+    Raises:
+        ValueError: If any of the names is a built-in function, or any of the
+            arguments definitions is not valid.
+
+    """
+    if isinstance(names, str):
+        names = names.split(',')
+    names = [name.strip() for name in names]
+    fdefs = FunctionObject._definitions()
+    for name in names:
+        if name in fdefs and fdefs[name]['id'] not in _CUSTOM_FUNCTIONS:
+            raise ValueError(ERR_FUNC_ALREADY_DEFINED.format(name))
+    if isinstance(args, str):
+        args = [args]
+    func_args = list()
+    for raw_arg in args:
+        func_arg = [a.strip() for a in str(raw_arg).split(',')]
+        if len(func_arg) != 2 or not _PLAIN_REGEX.match(func_arg[0]) \
+           or func_arg[1] not in ('man', 'opt'):
+            raise ValueError(ERR_BAD_ARG_DEF.format(raw_arg))
+        func_args.append(func_arg)
+    for name in names:
+        fdefs[name] = {'id': names[0], 'args': func_args}
+    _CUSTOM_FUNCTIONS[names[0]] = (scalar, batch)
+    # Interned specs may have the previous definition.
+    _SPEC_FUNCTIONS.clear()
+    _FIELD_SPECS.clear()
+
+def explain (template, sample=None, repeat=100):
+    """Returns a report of how each field of *template* is formatted.
+
+    *template* is a hformatted string or a Template. The report is a list
+    with a dict per field, in the order they are converted (deepest first):
+
+        index (int): Position of the field in that order.
+        level (int): Nesting level, being 1 the top-level fields.
+        text (str): Field text, with '{#<index>}' for the nested fields.
+        expression (str): Expression, or None if not known (it depends on
+            the nested fields, and there is no *sample*).
+        functions (list): (name, args) of each function, or None.
+        specs (str): Python-like specs, or None if they depend on the value
+            (relative widths) or are not known.
+        steps (list): Extra steps, besides the Python-like specs: 'custom',
+            'separators', 'trim', 'relative width', 'multichar fill',
+            'canvas', 'wrap' and 'block'.
+        paths (dict): Tells whether the field takes each fast path:
+            parsed: Parsed when compiling, instead of when formatting.
+            skeleton: Filled in its skeleton, so it is only parsed again
+                if its nested fields conversions are not safe. With *sample*,
+                whether the skeleton was filled with its conversions (False
+                if the field is parsed again on every formatting). None if it
+                has no nested fields.
+            plain: Its expression is just a name or a positional argument.
+            single_format: Needs a single 'format()' call.
+            memo: Its conversions are memoized.
+            shared: Its value is shared with other fields.
+            literal: Its expression falls back to a literal string, as it
+                reads names not given. None if there is no *sample*.
+        cost (float): Average seconds converting the field (parsing it, if
+            needed, evaluating it and applying its functions). None if there
+            is no *sample*.
+
+    *sample* gives the arguments for measuring: a dict of keyword arguments,
+    or a list of positional ones (as in 'Template.format_many()'). Fields are
+    converted *repeat* times with them.
+
+    """
+    if not isinstance(template, Template):
+        template = hfcompile(template)
+    fields = template._fields
+    hf = template._formatter((), dict())
+    parsed = [field['parsed'] for field in fields]
+    costs = None
+    filled = [field['skeleton'] is not None for field in fields]
+    if sample is not None:
+        if isinstance(sample, dict):
+            args, kwargs = (), sample
+        else:
+            args, kwargs = tuple(sample), dict()
+        costs = [0.0] * len(fields)
+        for _ in range(repeat):
+            hf = template._formatter(args, kwargs)
+            conversions = list()
+            for index, field in enumerate(fields):
+                if filled[index] and field['parsed'] is None:
+                    filled[index] = template._fill_skeleton(
+                        field['skeleton'], conversions) is not None
+                start = _timer()
+                parsed[index] = template._parse(hf, field, conversions)
+                conversions.append(template._convert_field(hf, field,
+                                                           parsed[index]))
+                costs[index] += _timer() - start
+
+    report = list()
+    measured = template.display_width or template.encoding
+    for index, (field, depth) in enumerate(zip(fields, template._depths())):
+        entry = {
+            'index': index,
+            'level': depth,
+            'text': ''.join([p if not isinstance(p, int) else
+                             '{#' + str(p) + '}' for p in field['pieces']]),
+            'expression': None,
+            'functions': None,
+            'specs': None,
+            'steps': None,
+            'paths': {
+                'parsed': field['parsed'] is not None,
+                'skeleton': None,
+                'plain': None,
+                'single_format': None,
+                'memo': field['memo'] is not None,
+                'shared': field['shared'] is not None,
+                'literal': None,
+            },
+            'cost': costs[index] / repeat if costs else None,
+        }
+        paths = entry['paths']
+        if field['parsed'] is None:
+            paths['skeleton'] = filled[index]
+        if parsed[index] is not None:
+            expression = hf._normalize(parsed[index][0])
+            spec = field['spec'] or _field_spec(parsed[index][1])
+            entry['expression'] = expression
+            entry['functions'] = [fobj.key for fobj in parsed[index][1]]
+            entry['specs'] = spec.specs
+            entry['steps'] = spec._steps()
+            paths['plain'] = bool(_PLAIN_REGEX.match(expression))
+            paths['single_format'] = not (
+                spec._separators or spec._trim or spec._relative is not None
+                or (measured and spec._width))
+            if sample is not None:
+                paths['literal'] = _falls_back(hf, expression)
+        report.append(entry)
+    return report
+
+def _falls_back (hf, expression):
+    """Tells if the expression is taken as a literal, as it reads names not
+    given."""
+    try:
+        eval(_expression_code(hf._translate(expression)), _EVAL_GLOBALS,
+             hf.given_args)
+    except NameError:
+        return True
+    except Exception:
+        pass
+    return False
+
+def save_cache (path, templates=None):
+    """Saves the compiled templates into the cache file *path*.
+
+    By default, saves every template compiled or preloaded in this process.
+    Partial templates (see 'Template.partial()') are not saved, as they are
+    not what 'hfcompile()' returns for their string; and neither are the ones
+    that cannot be pickled (such as those using custom functions defined with
+    lambdas). The file is tied to this exact version of the Human Formatter.
+    Returns the number of templates saved.
+
+    """
+    if templates is None:
+        entries = dict(_COMPILED)
+    else:
+        entries = dict(((t.original, t.encoding, t.memo_size, t.display_width,
+                         t.share_expressions), t) for t in templates
+                       if not t._fixed)
+    for key, template in list(entries.items()):
+        try:
+            pickle.dumps(template, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            del entries[key]
+    data = {'version': _cache_version(), 'templates': entries}
+    # Written apart and then moved, so no process can read it half-written.
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as cache_file:
+            pickle.dump(data, cache_file, pickle.HIGHEST_PROTOCOL)
+        getattr(os, 'replace', os.rename)(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return len(entries)
+
+def preload_cache (path):
+    """Loads the templates saved in the cache file *path*.
+
+    Those templates are returned by 'hfcompile()' with no compiling. Calling
+    it before forking lets the child processes share them. If the file does
+    not exist, is broken or belongs to another version, nothing is loaded.
+    As with 'hfcompile()', only the last templates (up to '_COMPILED_LIMIT')
+    are kept. Returns the number of templates loaded.
+
+    Cache files are unpickled, so they must come from a trusted source.
+
+    """
+    try:
+        with open(path, 'rb') as cache_file:
+            data = pickle.load(cache_file)
+    except Exception:
+        return 0
+    if not isinstance(data, dict) or data.get('version') != _cache_version():
+        return 0
+    templates = list(data['templates'].items())[-_COMPILED_LIMIT:]
+    for key, template in templates:
+        _COMPILED.pop(key, None)    # Loaded ones go last, as the newest.
+        _COMPILED[key] = template
+    while len(_COMPILED) > _COMPILED_LIMIT:
+        _COMPILED.popitem(last=False)
+    return len(templates)
+
+def _cache_version ():
+    """Returns the digest of the sources that the compiled templates rely on."""
+    digest = hashlib.sha1()
+    for path in (os.path.abspath(__file__).rsplit('.', 1)[0] + '.py',
+                 _FDEFS_FILE):
+        with open(path, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def _thread_pool (workers):
+    """Returns the pool of *workers* threads of this process, creating it the
+    first time."""
+    key = (os.getpid(), workers)
+    pool = _THREAD_POOLS.get(key)
+    if pool is None:
+        with _THREAD_POOLS_LOCK:
+            pool = _THREAD_POOLS.get(key)
+            if pool is None:
+                from multiprocessing.pool import ThreadPool
+                # Pools inherited from a parent process have no threads.
+                for other in [k for k in _THREAD_POOLS if k[0] != key[0]]:
+                    del _THREAD_POOLS[other]
+                pool = _THREAD_POOLS[key] = ThreadPool(workers)
+    return pool
+
+def _pooled (function):
+    """Returns *function* marking the pool thread running it, so the nested
+    concurrent formattings it starts do not wait for that same pool."""
+    def pooled (*args):
+        _pool_thread.busy = True
+        try:
+            return function(*args)
+        finally:
+            _pool_thread.busy = False
+    return pooled
+
+def _arguments (kwargs, mapping=None):
+    """Returns the keyword arguments dict used to evaluate the expressions.
+
+    A plain dict is faster to evaluate with, so the lazy one is only used if
+    there is any lazy value, or a mapping to look up.
+
+    """
+    if mapping is not None:
+        return _LazyArguments(kwargs, mapping)
+    for value in kwargs.values():
+        if isinstance(value, Lazy):
+            return _LazyArguments(kwargs)
+    return kwargs
+
+def _expression_names (expression):
+    """Returns the names the expression reads, or () if it is not valid."""
+    names = _NAMES.get(expression)
+    if names is None:
+        if len(_NAMES) >= _CODES_LIMIT:
+            _NAMES.clear()
+        names = _NAMES[expression] = _parse_names(expression)
+    return names
+
+def _parse_names (expression):
+    """Returns the names the expression reads, walking its syntax tree."""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        return ()
+    loaded = set()
+    stored = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.add(node.id)
+            else:
+                stored.add(node.id)     # Comprehensions variables.
+    return tuple(loaded - stored)
+
+def _expression_code (fake_expr):
+    """Returns the code object of the expression, compiling it just once."""
+    code = _CODES.get(fake_expr)
+    if code is None:
+        if len(_CODES) >= _CODES_LIMIT:
+            _CODES.clear()
+        # Just like 'eval()' of a string, leading spaces and tabs are skipped.
+        code = _CODES[fake_expr] = compile(fake_expr.lstrip(' \t'),
+                                           '<hformat>', 'eval')
+    return code
+
+def _field_spec (functions):
+    """Returns the FieldSpec of *functions*, interned by their key."""
+    key = tuple([fobj.key for fobj in functions])
+    spec = _FIELD_SPECS.get(key)
+    if spec is None:
+        if len(_FIELD_SPECS) >= _SPECS_LIMIT:
+            _FIELD_SPECS.clear()
+        spec = _FIELD_SPECS[key] = FieldSpec(functions)
+    return spec
+
+def _bounded_repr (value, size):
+    """Returns the repr of *value*, or just its first chars, *size* at least.
+
+    The containers are walked only until the repr reaches *size*.
+
+    """
+    chunks = list()
+    length = 0
+    for chunk in _repr_chunks(value, size, set()):
+        chunks.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return ''.join(chunks)
+
+def _repr_chunks (value, size, running):
+    """Yields the repr of *value* in chunks, just as 'repr()' builds it.
+
+    *running* has the ids of the containers being walked, so recursive ones
+    are written as 'repr()' does. A text longer than *size* may be yielded
+    incomplete, as the repr is long enough with it.
+
+    """
+    kind = type(value)
+    if kind not in _CONTAINER_TYPES:
+        if kind is str and len(value) > size:
+            # Escapes are char by char, but the quotes depend on all of them.
+            head = repr(value[:size])
+            if _repr_quote(value) == _repr_quote(value[:size]):
+                yield head[:-1]
+                return
+        yield repr(value)
+        return
+    if id(value) in running:
+        yield {dict: '{...}', tuple: '(...)'}.get(kind, '[...]')
+        return
+    if not value and kind in (set, frozenset):
+        yield kind.__name__ + '()'
+        return
+
+    running.add(id(value))
+    if kind is dict:
+        yield '{'
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield ', '
+            for chunk in _repr_chunks(key, size, running):
+                yield chunk
+            yield ': '
+            for chunk in _repr_chunks(item, size, running):
+                yield chunk
+        yield '}'
+    else:
+        opening, closing = {list: ('[', ']'), tuple: ('(', ')'),
+                            set: ('{', '}'),
+                            frozenset: ('frozenset({', '})')}[kind]
+        yield opening
+        for i, item in enumerate(value):
+            if i:
+                yield ', '
+            for chunk in _repr_chunks(item, size, running):
+                yield chunk
+        if kind is tuple and len(value) == 1:
+            yield ','
+        yield closing
+    running.discard(id(value))
+
+def _repr_quote (text):
+    """Returns the quote 'repr()' uses for *text*."""
+    return '"' if "'" in text and '"' not in text else "'"
+
+def _text_lines (text):
+    """Yields the lines of *text*, without their line breaks.
+
+    Just like 'str.splitlines()' (for '\\n' and '\\r\\n' breaks), but without
+    building the list; although an empty text is still one empty line.
+
+    """
+    start = 0
+    end = text.find('\n')
+    while end != -1:
+        yield text[start:end-1] if end > start and text[end-1] == '\r' \
+              else text[start:end]
+        start = end + 1
+        end = text.find('\n', start)
+    if start < len(text) or not text:
+        yield text[start:]
+
+
+def _reflow (lines, size, measure):
+    """Yields *lines* with their words rearranged in lines of *size* at most.
+
+    Words are separated by whitespace, and the ones longer than *size* are
+    cut. Empty lines are kept, as paragraph separators.
+
+    """
+    for line in lines:
+        current = list()
+        current_size = -1   # Joining spaces are counted before each word.
+        for match in _WORD_REGEX.finditer(line):
+            word = match.group()
+            word_size = measure(word)
+            if word_size > size:
+                if current:
+                    yield ' '.join(current)
+                    current, current_size = list(), -1
+                # The word is walked once, adding up the width of each char,
+                # and cut whenever the next char does not fit (a piece has one
+                # char at least). The last piece goes on as a word.
+                start = word_size = 0
+                for index, char in enumerate(word):
+                    char_size = measure(char)
+                    if word_size + char_size > size and index > start:
+                        yield word[start:index]
+                        start, word_size = index, 0
+                    word_size += char_size
+                word = word[start:]
+            if current and current_size + 1 + word_size > size:
+                yield ' '.join(current)
+                current, current_size = list(), -1
+            current.append(word)
+            current_size += 1 + word_size
+        if current or not line.strip():
+            yield ' '.join(current)
+
 
 #
 # Classes
@@ -125,6 +816,11 @@ class HumanFormatter (object):
         original (str): Original string
         final (str): Final string (after conversion)
         given_args (list): List of arguments given along with the original str.
+        encoding (str): If set, 'format()' returns the result encoded with it,
+            and fields widths are measured in encoded bytes. None by default.
+        display_width (bool): If True, fields widths are measured in terminal
+            cells, so wide (CJK, emoji) and combining chars are aligned right.
+            It has preference over 'encoding'. False by default.
 
     Methods:
         format() -> str: Given a formatting string and the arguments involved,
@@ -133,17 +829,25 @@ class HumanFormatter (object):
             a tuple with (expression, function_list), where 'expression' is the
             part that will be outputted, and the 'function_list' is the list
             with all the FunctionObjects created for the specifications (specs).
+        evaluate() -> object: Given the expression of a parsed token, returns
+            its value, evaluated with the given arguments.
         convert() -> str: Given the 'parse()' tuple output, identifies and
             interpretes all the functions from this token and builds the final
             string, returning it.
+        apply() -> str: Given an evaluated expression and its functions list,
+            builds the final string, just like 'convert()' does.
 
     """
-    def __init__ (self):
+    def __init__ (self, encoding=None, display_width=False):
         """Initializes some private properties."""
         self.original = ''
         self.final = ''
         self.given_args = list()
+        self.encoding = encoding
+        self.display_width = display_width
         self._positional_args_index = 0
+        self._shared_values = None  # Values of the expressions shared by
+                                    # the fields of a template.
 
 
     def format (self__, format_string, *args, **kwargs):
@@ -154,7 +858,7 @@ class HumanFormatter (object):
 
         """
         self__.original = format_string
-        self__.given_args = kwargs
+        self__.given_args = _arguments(kwargs)
         self__.given_args['__args__'] = args  # Simplifies the args check.
 
         # Identify every sub-string to be formatted (each 'token'):
@@ -179,6 +883,8 @@ class HumanFormatter (object):
                     final = self__.convert(parsed_token)
                     token.conversion = final
 
+        if self__.encoding:
+            return final.encode(self__.encoding)
         return final
 
 
@@ -189,7 +895,8 @@ class HumanFormatter (object):
         1. Placehold every special char or substring, such as literals.
         2. Separate *expression* from *specs*.
         3. Identify each function in the specs, and create a list of "function
-        objects", which store all important info.
+        objects", which store all important info. Specs already identified
+        (in any template) are just looked up by their text.
         4. Un-placehold every placeholders and return a tuple (expr, list).
 
         """
@@ -198,9 +905,12 @@ class HumanFormatter (object):
         #   - Chars after escape char !
         #   - Substrings between quotes. The quote char will be chosen in
         #   runtime, selecting the one that appears the most between ' and ".
-        safe_string = phhandler.after(token, ESCAPE_CHAR, 1)
         quote_char = "'" if token.count("'") >= token.count('"') else '"'
-        safe_string = phhandler.between(safe_string, quote_char)
+        if ESCAPE_CHAR in token or quote_char in token:
+            safe_string = phhandler.after(token, ESCAPE_CHAR, 1)
+            safe_string = phhandler.between(safe_string, quote_char)
+        else:
+            safe_string = token     # Nothing to protect.
 
         # Separating expression from specs. Format is '{expression[:specs]}'
         expression = specs = ''
@@ -214,6 +924,14 @@ class HumanFormatter (object):
 
         functions = list()  # List for FunctionObjects.
         if specs:
+            # The specs text (as written) and the quote char, if it is used
+            # there, identify the functions.
+            spec_text = phhandler.revert(specs)
+            spec_key = (spec_text, quote_char if quote_char in spec_text
+                                   else '')
+            interned = _SPEC_FUNCTIONS.get(spec_key)
+            if interned is not None:
+                return (expression, list(interned))
             # Format is 'function[([arg1, arg2, ..., argN])][, function...]'
             # The functions separator can be the comma (,) or the semicolon (;).
             safe_specs = phhandler.between(specs, '(', ')')
@@ -239,10 +957,41 @@ class HumanFormatter (object):
                 # is created.
                 functions.append(FunctionObject(func_name, func_args))
 
+            if len(_SPEC_FUNCTIONS) >= _SPECS_LIMIT:
+                _SPEC_FUNCTIONS.clear()
+            _SPEC_FUNCTIONS[spec_key] = tuple(functions)
+
         # The tuple (expression, functions) is returned
         return (expression, functions)
 
 
+    def evaluate (self, expression):
+        """Evaluation function.
+
+        Given the expression of a parsed token, returns its value, evaluated
+        with the given arguments as local variables. If the evaluation raises
+        a NameError, the expression is treated as a literal string.
+
+        """
+        expression = self._normalize(expression)
+
+        # Some translations are made in order to allow positional arguments
+        # evaluation:
+        fake_expr = self._translate(expression)
+
+        # The expression is evaluated. If it raises an error while evaluating (
+        # but not if the expression fails), it will treat it as a literal string
+        try:
+            final_expr = eval(_expression_code(fake_expr), _EVAL_GLOBALS,
+                              self.given_args)
+        except NameError:
+            final_expr = expression
+
+        # TODO: Catch 'SyntaxWarning' int object not subscriptable
+
+        return final_expr
+
+
     def convert (self, parsed_token):
         """Conversion function.
 
@@ -258,6 +1007,33 @@ class HumanFormatter (object):
         expression, functions = parsed_token
 
         # A. Expression
+        final_expr = self.evaluate(expression)
+
+        # B. Functions
+        return self.apply(final_expr, functions)
+
+
+    def apply (self, final_expr, functions):
+        """Specification function.
+
+        Given an already evaluated expression and the list of FunctionObjects
+        of its token, applies every function to it and returns the resultant
+        string. This is the second half of 'convert()'.
+
+        """
+        # B. Functions.
+        # The functions are interpreted by a FieldSpec, which can also be kept
+        # and applied to many values (as templates do).
+        conversion = _field_spec(functions).format(final_expr,
+                                                   self._measurer())
+
+        # Returning the final string
+        self.final = conversion
+        return conversion
+
+
+    def _normalize (self, expression):
+        """Turns positional arguments references into the '_<pos>_' format."""
         # Positional arguments reference is replaced with keyword '__args__[]',
         # so evaluation is still posible.
         if not expression:
@@ -274,9 +1050,11 @@ class HumanFormatter (object):
         else:
             if expression.isnumeric():
                 expression = '_' + expression + '_'
+        return expression
 
-        # Some translations are made in order to allow positional arguments
-        # evaluation:
+
+    def _translate (self, expression):
+        """Translates positional arguments references into '__args__[]'."""
         fake_expr = expression
         for index in range(len(self.given_args['__args__'])):
             fake_expr = fake_expr.replace("{}.".format(index),
@@ -285,46 +1063,156 @@ class HumanFormatter (object):
                                           "__args__[{}][".format(index))
             fake_expr = fake_expr.replace("_{}_".format(index),
                                           "__args__[{}]".format(index))
+        return fake_expr
 
-        # The expression is evaluated. If it raises an error while evaluating (
-        # but not if the expression fails), it will treat it as a literal string
+
+    def _measure (self, string):
+        """Returns the length of *string* in the formatter output units."""
+        if self.encoding:
+            return len(string.encode(self.encoding))
+        return len(string)
+
+
+    def _measurer (self):
+        """Returns the function that measures widths, or None to use chars."""
+        if self.display_width:
+            return _display_width
+        if self.encoding:
+            return self._measure
+        return None
+
+
+
+class Lazy (object):
+    """Lazy Class
+
+    Wrapper for an argument whose value is costly to compute. When given as
+    a keyword argument, its function is only called if an expression uses it,
+    and just once per formatting, no matter how many expressions use it.
+
+    Public attributes:
+        function (callable): Function, with no arguments, that returns the
+            value.
+
+    """
+    def __init__ (self, function):
+        self.function = function
+
+
+    def __call__ (self):
+        return self.function()
+
+
+    def __repr__ (self):
+        return "Lazy Argument for {!r}".format(self.function)
+
+
+
+class _LazyArguments (dict):
+    """Keyword arguments dict that computes the lazy values when read.
+
+    Names not found are looked up in the *mapping*, if given. Every value is
+    computed or looked up once, and then kept.
+
+    """
+    def __init__ (self, kwargs, mapping=None):
+        dict.__init__(self, kwargs)
+        self._mapping = mapping
+        self._locks = dict()    # Lazy values being computed, by name.
+
+
+    def __getitem__ (self, name):
+        value = dict.__getitem__(self, name)
+        if isinstance(value, Lazy):
+            # Fields may be evaluated by many threads at the same time (see
+            # 'Template.format_concurrent()'), but the value is computed once.
+            with self._locks.setdefault(name, threading.Lock()):
+                value = dict.__getitem__(self, name)
+                if isinstance(value, Lazy):
+                    value = value()
+                    dict.__setitem__(self, name, value)
+        return value
+
+
+    def __missing__ (self, name):
+        if self._mapping is None:
+            raise KeyError(name)
+        value = self._mapping[name]
+        dict.__setitem__(self, name, value)
+        return value
+
+
+    def get (self, name, default=None):
         try:
-            final_expr = eval(fake_expr, None, self.given_args)
-        except NameError:
-            final_expr = expression
+            return self[name]
+        except KeyError:
+            return default
 
-        # TODO: Catch 'SyntaxWarning' int object not subscriptable
 
 
-        # B. Functions.
-        # Each function may modify one of the variables that will end up forming
-        # the Python-like specs:
-        #   [[fill]align][sign][alter][zero][width][comma][.precision][ptype]
+class FieldSpec (object):
+    """FieldSpec Class
+
+    Interpretation of the functions of a field. All the functions are looked
+    up and translated into the Python-like specs (and the extra steps that
+    the Human Formatter adds) just once, when the object is created; so it
+    can format any number of values afterwards without looking at them again.
+
+    The steps are done in this order: custom functions (see 'register_
+    function()'), miles and decimals separators, trimming, the Python-like
+    specs themselves, multichar and canvas filling, and wrapping.
+
+    With the block functions ('reflow', 'indent' and 'lines'), the value is
+    handled as text made of lines: it is split in lines (and reflowed to a
+    width, if asked), and every step but the custom functions is applied to
+    each line, which is then indented.
+
+    Public attributes:
+        key (tuple): Hashable identification of the functions.
+        specs (str): Python-like specs, when they do not depend on the value
+            (otherwise, None):
+            [[fill]align][sign][alter][zero][width][comma][.precision][ptype]
+
+    Methods:
+        format() -> str: Formats a value, returning the resultant string.
+        format_many() -> list: Formats a list of values, using the batch
+            implementation of the custom functions, if they have it.
+        lines() -> generator: Yields the lines of a value formatted as a
+            block, one by one, so large values are never held whole.
+        from_string() -> FieldSpec: Class method. Returns the FieldSpec of
+            the given specs text (the part after the colon).
+
+    """
+    def __init__ (self, functions):
+        self.key = tuple([fobj.key for fobj in functions])
 
         # Function that searches for a FunctionObject given various posible
-        # names. If it finds it, will return True, and store the object in
-        # local property '_func'. Else, it will return False, and store None.
+        # names. Returns the first one found, or None.
         def get_func (*names):
-            self._func = None
             for name in names:
                 for fobj in functions:
                     if fobj.name == name:
-                        self._func = fobj
-                        return True
-            return False
+                        return fobj
+            return None
 
-        # Control variables, generally for extra features
-        _decsep = ''
+        # Custom functions, resolved right now to their implementations.
+        self._customs = list()
+        for fobj in functions:
+            if fobj.name in _CUSTOM_FUNCTIONS:
+                scalar, batch = _CUSTOM_FUNCTIONS[fobj.name]
+                self._customs.append((scalar, batch, fobj.key[1]))
 
         # Fill
         #   Will also define 'align', in case it is not given.
         #   Can be set from functions 'fill', 'field' and 'canvas'.
-        fill = align = wrapper = ''
-        if get_func('fill', 'field', 'canvas'):
+        fill = align = wrapper = multifill = ''
+        self._canvas = None
+        func = get_func('fill', 'field', 'canvas')
+        if func:
             align = '<'     # Default aligning.
-            fill = self._func.args.get('fillchar', ' ')
+            fill = func.args.get('fillchar') or ' '
 
-            if self._func.name == 'canvas':
+            if func.name == 'canvas':
                 # Canvas filling behave differently depending on the format:
                 if len(fill) % 2:
                     # Odd: mid char is the fill char, and the others are wrappers.
@@ -334,18 +1222,25 @@ class HumanFormatter (object):
                     # Even: half fills before the string, and half after.
                     wrapper = fill[:len(fill)//2] + fill[len(fill)//2:]
                     fill = _CANVAS_FILL_PLACEHOLDER
+                    self._canvas = (wrapper[:len(wrapper)//2],
+                                    wrapper[len(wrapper)//2:])
 
             if len(fill) > 1:
                 # Multicharacter filling, handled after Python str.format().
                 multifill = fill
                 fill = _MULTICHAR_FILL_PLACEHOLDER
+        self._multifill = multifill
+        # Only a real char has a size of its own (see 'format()').
+        self._fill = fill if fill not in (_MULTICHAR_FILL_PLACEHOLDER,
+                                          _CANVAS_FILL_PLACEHOLDER) else ''
 
         # Align
         #   Can be set from functions 'align', 'left', 'right', 'center',
         #   'field' and 'canvas'.
         raw_align = ''
-        if get_func('align', 'field', 'canvas'):
-            raw_align = self._func.args.get('align', '<')
+        func = get_func('align', 'field', 'canvas')
+        if func:
+            raw_align = func.args.get('align', '<')
         if get_func('left') or raw_align in ('left', '<'):
             align = '<'
         elif get_func('right') or raw_align in ('right', '>'):
@@ -358,42 +1253,24 @@ class HumanFormatter (object):
         # Sign
         #   Can be obtained from 'sign'.
         sign = ''
-        if get_func('sign'):
-            sign = self._func.args.get(0, '+') or '+'
+        func = get_func('sign')
+        if func:
+            sign = func.args.get(0, '+') or '+'
 
         # Precision
         #   Can be set with 'precision' and 'float'.
         precision = ''
-        if get_func('precision', 'float'):
-            aux = self._func.args.get('prec', '')
+        func = get_func('precision', 'float')
+        if func:
+            aux = func.args.get('prec', '')
             precision = '.'+aux if aux else ''
 
         # Type (ptype)
         ptype = alter = ''
-        _ptype_dict = {
-            'string': '',
-            'bin': 'b',
-            'rawbin': 'b',
-            'char': 'c',
-            'decimal': 'd',
-            'octal': 'o',
-            'rawoctal': 'o',
-            'hex': 'x',
-            'Hex': 'X',
-            'rawhex': 'x',
-            'rawHex': 'X',
-            'number': 'n',
-            'exp': 'e',
-            'Exp': 'E',
-            'float': 'f',
-            'Float': 'F',
-            'general': 'g',
-            'General': 'G',
-            'percentage': '%'
-        }
-        if get_func(*_ptype_dict.keys()):
-            ptype = _ptype_dict[self._func.name]
-            if self._func.name in ('bin', 'octal', 'hex', 'Hex'):
+        func = get_func(*_PTYPES.keys())
+        if func:
+            ptype = _PTYPES[func.name]
+            if func.name in ('bin', 'octal', 'hex', 'Hex'):
                 alter = '#'
 
         # Pre-format functions
@@ -405,113 +1282,1172 @@ class HumanFormatter (object):
 
         # Comma - Miles & Decimals separator
         #   Can be set with 'milesep' (for miles) and 'decsep' (for decimals).
-        comma = ''
-        if get_func('milesep'):
-            comma = self._func.args.get(0, ',') or ','
-        if get_func('floatsep'):
-            _decsep = self._func.args.get(0, '.') or '.'
-        if comma or _decsep:
-            # Output will have the miles separator default char comma and the
-            # decimals separator default point replaced with user given chars,
-            # if any.
-            comma = comma or ','
-            _decsep = _decsep or '.'
-            preformat = "{0:{1},{2}{3}}".format(final_expr, alter, precision,
-                                                ptype)
-            # , --> \2046
-            preformat = preformat.replace(',', _MISC_PLACEHOLDER)
-            # . --> _decsep
-            preformat = preformat.replace('.', _decsep)
-            # \2046 --> comma
-            preformat = preformat.replace(_MISC_PLACEHOLDER, comma)
+        #   Output will have the miles separator default char comma and the
+        #   decimals separator default point replaced with user given chars.
+        comma = decsep = ''
+        self._separators = None
+        func = get_func('milesep')
+        if func:
+            comma = func.args.get(0, ',') or ','
+        func = get_func('floatsep')
+        if func:
+            decsep = func.args.get(0, '.') or '.'
+        if comma or decsep:
+            self._separators = (alter+','+precision+ptype, comma or ',',
+                                decsep or '.')
             alter = precision = ptype = comma = ''
-            final_expr = preformat
 
         # Trim (extra)
         #   Can be set with 'trim'.
-        if get_func('trim'):
-            limit = int(self._func.args.get(0, 100))
-            stopchar = self._func.args.get(1, None)
-            preformat = "{0:{1}{2}{3}}".format(final_expr, alter, precision,
-                                               ptype)
-            if stopchar:
-                final_expr = preformat[:limit-len(stopchar)] + stopchar
-            else:
-                final_expr = preformat[:limit]
+        self._trim = None
+        func = get_func('trim')
+        if func:
+            self._trim = (alter+precision+ptype, int(func.args.get(0, 100)),
+                          func.args.get(1, None))
             alter = precision = ptype = ''  # Reset, as they won't be used.
 
         # Width
         #   Can be obtained from 'width', 'zwidth', 'field' and 'canvas'.
         width = zero = ''
-        if get_func('width', 'field', 'canvas', 'zwidth'):
-            width = self._func.args['size']
-
-            if self._func.name == 'zwidth':
+        self._relative = None
+        func = get_func('width', 'field', 'canvas', 'zwidth')
+        if func:
+            width = func.args['size']
+            if func.name == 'zwidth':
                 zero = '0'
-
             if width.startswith('+'):
                 # Relative width, needs to know which will be the final length
-                # of the string.
-                # Ignores *trim* function.
-                width = str(int(width[1:]) \
-                            + len("{0:{1}{2}{3}}".format(final_expr, alter,
-                                                          precision, ptype)))
+                # of the string. Ignores *trim* function.
+                self._relative = int(width[1:])
+                width = ''
+        self._width = width
+
+        # The Python-like specs are kept in two halves around the width, for
+        # the cases where the width depends on the value.
+        self._head = fill+align+sign+alter+zero
+        self._tail = comma+precision+ptype
+        self._inner = alter+precision+ptype
+        self._content = sign+alter+comma+precision+ptype
+        self.specs = None
+        if self._relative is None:
+            self.specs = self._head+width+self._tail
 
+        # Wrapping (extra)
+        #   Can be set with function 'wrap' and with 'canvas' arguments.
+        self._wrap = None
+        func = get_func('wrap')
+        if wrapper or func:
+            wrapper = wrapper or func.args.get(0, '')
+            self._wrap = (wrapper[:len(wrapper)//2], wrapper[len(wrapper)//2:])
+
+        # Block (extra)
+        #   Set with 'reflow', 'indent' and 'lines'. Kept as a tuple (size,
+        #   first line prefix, prefix), where a None size means no reflowing.
+        self._block = None
+        reflow = get_func('reflow')
+        indent = get_func('indent')
+        if reflow or indent or get_func('lines'):
+            size = int(reflow.args['size']) if reflow else None
+            first = prefix = ''
+            if indent:
+                prefix = self._prefix(indent.args['prefix'])
+                first = prefix if indent.args['first'] is None \
+                        else self._prefix(indent.args['first'])
+            self._block = (size, first, prefix)
+
+
+    @classmethod
+    def from_string (cls, specs):
+        """Returns the FieldSpec of the *specs* text."""
+        return cls(HumanFormatter().parse(':' + specs)[1])
+
+
+    def format (self, value, measure=None):
+        """Returns *value* formatted.
+
+        If a *measure* function is given, widths are measured with it instead
+        of counting chars.
+
+        """
+        for scalar, batch, args in self._customs:
+            value = scalar(value, *args)
+        if self._block:
+            return '\n'.join(self._block_lines(value, measure))
+        return self._specify(value, measure)
 
-        # Once all Python-original specs are completed, the conversion is made:
-        python_specs = fill+align+sign+alter+zero+width+comma+precision+ptype
-        #print(python_specs)
-        conversion = "{0:{1}}".format(final_expr, python_specs)
 
+    def lines (self, value, measure=None):
+        """Yields the lines of *value* formatted as a block.
+
+        The value is read in a single pass, and each line is yielded as soon
+        as it is formatted. Without block functions, the other functions are
+        applied to each line all the same.
+
+        """
+        for scalar, batch, args in self._customs:
+            value = scalar(value, *args)
+        return self._block_lines(value, measure)
+
+
+    def format_many (self, values, measure=None):
+        """Returns the list of *values* formatted."""
+        values = list(values)
+        for scalar, batch, args in self._customs:
+            if batch is not None:
+                values = list(batch(values, *args))
+            else:
+                values = [scalar(value, *args) for value in values]
+        if self._block:
+            return ['\n'.join(self._block_lines(value, measure))
+                    for value in values]
+        return [self._specify(value, measure) for value in values]
+
+
+    def _block_lines (self, value, measure):
+        """Yields the lines of *value* with every function but the custom ones
+        applied."""
+        size, prefix, next_prefix = self._block or (None, '', '')
+        lines = _text_lines(format(value, ''))
+        if size is not None:
+            lines = _reflow(lines, size, measure or len)
+        for line in lines:
+            yield prefix + self._specify(line, measure)
+            prefix = next_prefix
+
+
+    def _steps (self):
+        """Returns the names of the extra steps applied (see 'explain()')."""
+        steps = list()
+        for name, used in (('custom', self._customs),
+                           ('separators', self._separators),
+                           ('trim', self._trim),
+                           ('relative width', self._relative is not None),
+                           ('multichar fill', self._multifill),
+                           ('canvas', self._canvas),
+                           ('wrap', self._wrap),
+                           ('block', self._block)):
+            if used:
+                steps.append(name)
+        return steps
+
+
+    @staticmethod
+    def _trim_format (value, specs, size):
+        """Returns *value* formatted, or just its first chars, *size* at least.
+
+        Text is sliced before formatting it, and containers (with no specs)
+        only have their repr built up to *size*; so trimming large values
+        does not format them whole.
+
+        """
+        if size >= 0:
+            if type(value) in _TEXT_TYPES:
+                return format(value[:size], specs)
+            if not specs and type(value) in _CONTAINER_TYPES:
+                return _bounded_repr(value, size)
+        return format(value, specs)
+
+
+    @staticmethod
+    def _prefix (indent):
+        """Returns the prefix for an 'indent' argument (a size or a text)."""
+        return ' ' * int(indent) if indent.isdigit() else indent
+
+
+    def _specify (self, value, measure):
+        """Applies every function but the custom ones to *value*."""
+        if self._separators:
+            specs, comma, decsep = self._separators
+            preformat = format(value, specs)
+            # , --> \2046
+            preformat = preformat.replace(',', _MISC_PLACEHOLDER)
+            # . --> decsep
+            preformat = preformat.replace('.', decsep)
+            # \2046 --> comma
+            value = preformat.replace(_MISC_PLACEHOLDER, comma)
+
+        if self._trim:
+            specs, limit, stopchar = self._trim
+            preformat = self._trim_format(value, specs,
+                                          limit - len(stopchar or ''))
+            if stopchar:
+                value = preformat[:limit-len(stopchar)] + stopchar
+            else:
+                value = preformat[:limit]
+
+        specs = self.specs
+        if measure is not None and (self._width or self._relative is not None):
+            # Width is measured with *measure*, so the chars width given to
+            # Python is reduced by the extra size of the content, and the
+            # filling takes as much size as its char.
+            content = format(value, self._content)
+            if self._relative is not None:
+                width = self._relative + measure(format(value, self._inner))
+            else:
+                width = int(self._width)
+            fill_size = (measure(self._fill) if self._fill else 1) or 1
+            padding = max(width - measure(content), 0)
+            specs = self._head + str(len(content) + padding // fill_size) \
+                    + self._tail
+        elif self._relative is not None:
+            width = self._relative + len(format(value, self._inner))
+            specs = self._head + str(width) + self._tail
+        conversion = format(value, specs)
 
         # Then, some after-conversion alterations may take part:
         # Multichar filling (extra)
-        if fill == _MULTICHAR_FILL_PLACEHOLDER:
+        if self._multifill:
             # The current filling char is an special non-representable char that
             # now will be replaced with the correct chars in the correct order.
-            for i in range(conversion.count(_MULTICHAR_FILL_PLACEHOLDER)):
-                conversion = conversion.replace(_MULTICHAR_FILL_PLACEHOLDER,
-                                                multifill[i%len(multifill)], 1)
+            parts = conversion.split(_MULTICHAR_FILL_PLACEHOLDER)
+            multifill = self._multifill
+            out = [parts[0]]
+            for i, part in enumerate(parts[1:]):
+                out.append(multifill[i % len(multifill)])
+                out.append(part)
+            conversion = ''.join(out)
 
         # Canvas filling (extra)
-        if fill == _CANVAS_FILL_PLACEHOLDER:
+        if self._canvas:
             # The current filling char is an special non-representable char.
             # Those before the string will be replaced with the opening part
             # of the wrapper, and so will the other half with the closing part.
-            open_chars = wrapper[:len(wrapper)//2]
-            close_chars = wrapper[len(wrapper)//2:]
+            open_chars, close_chars = self._canvas
             n_chars = len(open_chars)
-
-            total = conversion.count(_CANVAS_FILL_PLACEHOLDER)
-            after = before = 0  # Chars to replace *after* and *before*.
-            for char in conversion:
-                if char != _CANVAS_FILL_PLACEHOLDER:
-                    break
+            before = len(conversion) \
+                     - len(conversion.lstrip(_CANVAS_FILL_PLACEHOLDER))
+            parts = conversion.split(_CANVAS_FILL_PLACEHOLDER)
+            out = [parts[0]]
+            for i, part in enumerate(parts[1:]):
+                if i < before:
+                    out.append(open_chars[i % n_chars])
                 else:
-                    before += 1
-            after = total - before
-
-            for i in range(before):
-                conversion = conversion.replace(_CANVAS_FILL_PLACEHOLDER,
-                                                open_chars[i%n_chars], 1)
-            for i in range(after):
-                conversion = conversion.replace(_CANVAS_FILL_PLACEHOLDER,
-                                                close_chars[i%n_chars], 1)
+                    out.append(close_chars[(i - before) % n_chars])
+                out.append(part)
+            conversion = ''.join(out)
 
         # Wrapping (extra)
-        #   Can be set with function 'wrap' and with 'canvas' arguments.
-        if wrapper or get_func('wrap'):
-            wrapper = wrapper or self._func.args.get(0, '')
-            open_chars = wrapper[:len(wrapper)//2]
-            close_chars = wrapper[len(wrapper)//2:]
+        if self._wrap:
+            open_chars, close_chars = self._wrap
             conversion = open_chars + conversion + close_chars
 
-        # Returning the final string
-        self.final = conversion
         return conversion
 
 
 
+class Template (object):
+    """Template Class
+
+    Compiled form of a hformatted string. The string is tokenized just once,
+    and every field without nested fields is also parsed just once, so each
+    formatting only has to convert the fields and join them with the literal
+    text around them.
+
+    If an encoding is given, the template outputs bytes, measuring the fields
+    widths in encoded bytes, and the literal text is kept already encoded. It
+    can also write the output directly into a preallocated buffer, which is
+    useful to fill fixed-width records row after row.
+
+    Optionally, each field can memoize its conversions (see 'ResultMemo'), so
+    a value that is formatted again is not converted twice. Also, fields with
+    the very same expression share its value, instead of evaluating it again.
+
+    Public attributes:
+        original (str): Original string.
+        encoding (str): Encoding of the output, or None to output strings.
+        memo_size (int): Maximum conversions memoized per field. 0 disables
+            the memoization, which is the default.
+        display_width (bool): If True, widths are measured in terminal cells.
+        names (frozenset): Names read by the expressions of the template, so
+            only those arguments need to be computed. Expressions made from
+            nested fields are not known until formatting, so their names are
+            not included. The builtins are listed apart.
+        builtin_names (frozenset): Names read by the expressions that are
+            also builtins (such as 'len' or 'id'). They are used as builtins
+            unless given as arguments, so callers that give any of them must
+            prefetch those too.
+        share_expressions (bool): If True (default), an expression repeated in
+            many fields is evaluated once per formatting, and its value shared
+            by all of them. Must be False if expressions have side effects.
+
+    Methods:
+        format() -> str: Given the arguments, returns the formatted string, as
+            'hformat()' would do. Returns bytes if the template has encoding.
+        format_map() -> str: Same as 'format()', but taking the arguments
+            from a mapping, only when they are used.
+        format_many() -> list: Given a list of records (the arguments of each
+            formatting), returns the list of formatted strings.
+        format_into() -> int: Given a writable buffer (bytearray, memoryview)
+            and an offset, writes the encoded output into it and returns the
+            number of bytes written. Needs the template to have encoding.
+        iformat() -> generator: Same as 'format()', but yields the output in
+            pieces, formatting each field when the output reaches it.
+        format_concurrent() -> str: Same as 'format()', but evaluating the
+            fields of the same level at the same time, in a pool of threads.
+        format_async() -> coroutine: Same as 'format()', but awaiting the
+            values of the fields of the same level at the same time, under
+            asyncio (Python 3.5+).
+        partial() -> Template: Given some keyword arguments, returns a new
+            template where the fields that only depend on them are already
+            formatted.
+        bind() -> BoundTemplate: Returns a bound template, which keeps the
+            last conversion of each field to reuse it while it does not change.
+        memo_stats() -> dict: Returns the memoization statistics of all the
+            fields together.
+
+    Raises:
+        ValueError: If the buffer is too small, or there is no encoding set.
+
+    """
+    def __init__ (self, format_string, encoding=None, memo_size=0,
+                  display_width=False, share_expressions=True):
+        self.original = format_string
+        self.encoding = encoding
+        self.memo_size = memo_size
+        self.display_width = display_width
+        self.share_expressions = share_expressions
+
+        # Fields are stored in the same order 'HumanFormatter.format()' would
+        # convert them: deeper levels first. Each one keeps its 'pieces', a
+        # list of literal strings and indexes of the fields nested inside it.
+        main_token = Token(format_string)
+        tokens_sorted = sorted(main_token.list().items(), key=lambda i: i[0],
+                               reverse=True)
+        # Empty expressions are numbered here, following that same order, so
+        # fields can be converted on their own.
+        hf = HumanFormatter()
+        indexes = dict()
+        auto_index = 0
+        self._fields = list()
+        for level, tokens in tokens_sorted:
+            if level == 0:
+                continue
+            for token in tokens:
+                indexes[id(token)] = len(self._fields)
+                field = {'pieces': self._split(token, indexes),
+                         'parsed': None,
+                         'auto': None,
+                         'skeleton': None,
+                         'spec': None,
+                         'shared': None,
+                         'memo': ResultMemo(memo_size) if memo_size else None}
+                if not token.token or token.token.lstrip().startswith(':'):
+                    field['auto'] = auto_index
+                    auto_index += 1
+                if not token.childs:
+                    # Nothing can change its text, so it is parsed right now.
+                    field['parsed'] = self._numbered(field,
+                                                     hf.parse(token.token))
+                    field['spec'] = _field_spec(field['parsed'][1])
+                else:
+                    field['skeleton'] = self._skeleton(hf, field['pieces'])
+                self._fields.append(field)
+
+        self._pieces = self._split(main_token, indexes)
+        self._fixed = dict()
+        self._prepare(hf)
+
+
+    def format (self__, *args, **kwargs):
+        """Returns the template formatted with the given arguments."""
+        return self__._output(self__._convert(args, kwargs))
+
+
+    def format_map (self, mapping):
+        """Returns the template formatted with the values of *mapping*.
+
+        Just like 'str.format_map()', *mapping* can be any object with
+        '__getitem__'. Each name is looked up only if an expression uses it,
+        and just once per formatting.
+
+        """
+        return self._output(self._convert_with(self._formatter((), dict(),
+                                                               mapping)))
+
+
+    def format_many (self, records):
+        """Formats many records at once, returning the list of outputs.
+
+        Each record is either a dict with the keyword arguments, or a list (or
+        tuple) with the positional ones. Fields are converted one at a time
+        for all the records, so custom functions with a batch implementation
+        are called just once per field.
+
+        """
+        hfs = list()
+        for record in records:
+            if isinstance(record, dict):
+                hfs.append(self._formatter((), dict(record)))
+            else:
+                hfs.append(self._formatter(tuple(record), dict()))
+        conversions = [list() for hf in hfs]
+        measure = hfs[0]._measurer() if hfs else None
+        for field in self._fields:
+            if field['spec'] is not None and field['memo'] is None:
+                expression = field['parsed'][0]
+                values = [self._evaluate(hf, field, expression) for hf in hfs]
+                for record_conversions, conversion in \
+                        zip(conversions, field['spec'].format_many(values,
+                                                                   measure)):
+                    record_conversions.append(conversion)
+            else:
+                for hf, record_conversions in zip(hfs, conversions):
+                    parsed = self._parse(hf, field, record_conversions)
+                    record_conversions.append(self._convert_field(hf, field,
+                                                                  parsed))
+        return [self._output(c) for c in conversions]
+
+
+    def format_into (self__, buffer__, offset__, *args, **kwargs):
+        """Writes the encoded template into *buffer__*, from *offset__*.
+
+        Each field is encoded and copied right into its place, so the whole
+        output is never built as a string. Returns the bytes written.
+
+        """
+        if not self__.encoding:
+            raise ValueError(ERR_NO_ENCODING.format(self__.original))
+        conversions = self__._convert(args, kwargs)
+        chunks = list()
+        size = 0
+        for piece in self__._encoded_pieces:
+            if isinstance(piece, int):
+                piece = conversions[piece].encode(self__.encoding)
+            chunks.append(piece)
+            size += len(piece)
+        if offset__ + size > len(buffer__):
+            raise ValueError(ERR_BUFFER_TOO_SMALL.format(len(buffer__), size,
+                                                         offset__))
+        position = offset__
+        for chunk in chunks:
+            buffer__[position:position+len(chunk)] = chunk
+            position += len(chunk)
+        return size
+
+
+    def iformat (self__, *args, **kwargs):
+        """Yields the formatted template in pieces, in the output order.
+
+        Each top-level field is converted (its nested fields first) only when
+        the output reaches it, and its conversion is forgotten once yielded,
+        so the first pieces are yielded right away. Pieces are encoded if the
+        template has an encoding.
+
+        Expressions are evaluated in the output order instead of deepest
+        first, so an error is raised after the pieces before its field.
+
+        """
+        hf = self__._formatter(args, kwargs)
+        for piece in self__._encoded_pieces or self__._pieces:
+            if isinstance(piece, int):
+                conversions = dict()
+                self__._convert_tree(hf, piece, conversions)
+                piece = conversions[piece]
+                if self__.encoding:
+                    piece = piece.encode(self__.encoding)
+            if piece:
+                yield piece
+
+
+    def format_concurrent (self__, workers__, *args, **kwargs):
+        """Returns the template formatted, evaluating the fields of the same
+        level in up to *workers__* threads at the same time.
+
+        Useful when expressions call slow, I/O bound functions. *workers__* is
+        either the number of threads, taken from a pool kept by the process
+        for that number, or an executor to evaluate with (anything with a
+        'map()' method, such as a 'concurrent.futures' executor or a
+        'ThreadPool'). The output is the same as 'format()'. If any field
+        fails, the rest of its level are still evaluated, and then the error
+        raised is the one 'format()' would have raised.
+
+        """
+        hf = self__._formatter(args, kwargs)
+        conversions = [None] * len(self__._fields)
+        evaluate = lambda expression: self__._evaluate_job(hf, expression)
+        if hasattr(workers__, 'map'):
+            executor = workers__
+        elif workers__ > 1 and not getattr(_pool_thread, 'busy', False):
+            executor = None     # Taken when a level has many jobs.
+            evaluate = _pooled(evaluate)
+        else:
+            # Nested in a field of another concurrent formatting, the pool
+            # could be waiting for this very thread.
+            workers__ = 1
+        for level in self__._levels():
+            parsed, jobs = self__._level_jobs(hf, level, conversions)
+            if len(jobs) > 1 and workers__ != 1:
+                if executor is None:
+                    executor = _thread_pool(workers__)
+                results = list(executor.map(evaluate, list(jobs.values())))
+            else:
+                results = [evaluate(e) for e in jobs.values()]
+            self__._level_conversions(hf, level, parsed,
+                                      dict(zip(jobs, results)), conversions)
+        return self__._output(conversions)
+
+
+    def format_async (self__, limit__, *args, **kwargs):
+        """Returns a coroutine that formats the template, under asyncio.
+
+        Fields whose values are awaitables (such as coroutines) are awaited,
+        the ones of the same level at the same time, up to *limit__* at once
+        (0 for no limit). Errors are raised just like 'format_concurrent()'
+        does. Needs Python 3.5+.
+
+        """
+        from asyncformat import format_async
+        return format_async(self__, limit__, args, kwargs)
+
+
+    def bind (self):
+        """Returns a *BoundTemplate* that re-renders only the changed fields."""
+        return BoundTemplate(self)
+
+
+    def partial (self, **fixed):
+        """Returns a new template with some keyword arguments already fixed.
+
+        Fields whose expression only reads fixed arguments are formatted right
+        now, and turned into literal text (fill, canvas and wrap included), so
+        the new template only formats the rest of them. Those fields must not
+        read positional arguments. The arguments given later are added to the
+        fixed ones, but do not change the fields already formatted.
+
+        """
+        template = copy.copy(self)
+        template._fixed = dict(self._fixed)
+        template._fixed.update(fixed)
+        hf = template._formatter((), dict())
+
+        conversions = [None] * len(self._fields)   # Of the folded fields.
+        new_indexes = dict()
+        fields = list()
+        for index, field in enumerate(self._fields):
+            pieces = self._fold(field['pieces'], conversions, new_indexes)
+            nested = any(isinstance(p, int) for p in pieces)
+            if not nested:
+                parsed = field['parsed']
+                if parsed is None:
+                    parsed = self._numbered(field, hf.parse(''.join(pieces)))
+                if self._foldable(hf._normalize(parsed[0]), template._fixed):
+                    conversions[index] = self._convert_field(hf, field, parsed)
+                    continue
+            field = dict(field)
+            field['pieces'] = pieces
+            field['shared'] = None
+            field['memo'] = ResultMemo(self.memo_size) if self.memo_size \
+                            else None
+            if nested:
+                field['skeleton'] = self._skeleton(hf, pieces)
+            elif field['parsed'] is None:
+                # All its nested fields were folded, so it is parsed now.
+                field['parsed'] = parsed
+                field['spec'] = _field_spec(parsed[1])
+                field['skeleton'] = None
+            new_indexes[index] = len(fields)
+            fields.append(field)
+
+        template._fields = fields
+        template._pieces = self._fold(self._pieces, conversions, new_indexes)
+        template._prepare(hf)
+        return template
+
+
+    def memo_stats (self):
+        """Returns the joined statistics of the fields memos."""
+        stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'size': 0}
+        for field in self._fields:
+            if field['memo'] is not None:
+                for key, value in field['memo'].stats().items():
+                    if key in stats:
+                        stats[key] += value
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+        return stats
+
+
+    def _formatter (self, args, kwargs, mapping=None):
+        """Returns a formatter ready to convert fields with the arguments."""
+        if self._fixed:
+            fixed = dict(self._fixed)
+            fixed.update(kwargs)
+            kwargs = fixed
+        hf = HumanFormatter(self.encoding, self.display_width)
+        hf.original = self.original
+        hf.given_args = _arguments(kwargs, mapping)
+        hf.given_args['__args__'] = args
+        if self._has_shared:
+            hf._shared_values = dict()
+        return hf
+
+
+    def _parse (self, hf, field, conversions):
+        """Returns the parsed field, parsing it now if it has nested fields."""
+        parsed = field['parsed']
+        if parsed is None:
+            parsed = self._fill_skeleton(field['skeleton'], conversions)
+        if parsed is None:
+            parsed = hf.parse(self._join(field['pieces'], conversions))
+        return self._numbered(field, parsed)
+
+
+    @classmethod
+    def _skeleton (cls, hf, pieces):
+        """Parses a field with nested fields, leaving holes for them.
+
+        Returns a tuple (expression, functions) like 'parse()' does, but where
+        the expression and each function arguments are lists of pieces, which
+        are either literals or indexes of the nested fields. Functions without
+        holes are kept as they are. If the holes are not just inside the
+        expression or the arguments, returns None.
+
+        """
+        holed = ''.join([p if not isinstance(p, int) else
+                         _HOLE_PLACEHOLDER + str(p) + _HOLE_PLACEHOLDER
+                         for p in pieces])
+        if ESCAPE_CHAR + _HOLE_PLACEHOLDER in holed:
+            return None
+        try:
+            expression, functions = hf.parse(holed)
+        except (NameError, TypeError, ValueError):
+            return None     # Holes in functions names or separators.
+        plan = list()
+        for fobj in functions:
+            args = fobj.key[1]
+            if any(_HOLE_PLACEHOLDER in arg for arg in args):
+                plan.append((fobj, [cls._holed_pieces(arg) for arg in args]))
+            else:
+                plan.append((fobj, None))
+        return (cls._holed_pieces(expression), plan)
+
+
+    @classmethod
+    def _fill_skeleton (cls, skeleton, conversions):
+        """Fills the skeleton holes, returning the parsed field.
+
+        If any nested conversion could be parsed differently than a literal,
+        returns None, so the field must be parsed as always.
+
+        """
+        if skeleton is None:
+            return None
+        expression, plan = skeleton
+        expression = cls._fill_holes(expression, conversions)
+        if expression is None:
+            return None
+        functions = list()
+        for fobj, args in plan:
+            if args is not None:
+                args = [cls._fill_holes(arg, conversions) for arg in args]
+                if None in args:
+                    return None
+                fobj = fobj.rebuild(args)
+            functions.append(fobj)
+        return (expression, functions)
+
+
+    @staticmethod
+    def _holed_pieces (string):
+        """Splits a string with holes into literals and nested indexes."""
+        pieces = _HOLE_REGEX.split(string)
+        # Odd elements are the captured indexes.
+        return [int(p) if i % 2 else p for i, p in enumerate(pieces) if p]
+
+
+    @staticmethod
+    def _fill_holes (pieces, conversions):
+        """Joins the pieces, or returns None if a conversion is not safe."""
+        out = list()
+        for piece in pieces:
+            if isinstance(piece, int):
+                piece = conversions[piece]
+                if _UNSAFE_HOLE_REGEX.search(piece):
+                    return None
+            out.append(piece)
+        return ''.join(out)
+
+
+    def _convert (self, args, kwargs):
+        """Converts every field, returning the list of conversions."""
+        return self._convert_with(self._formatter(args, kwargs))
+
+
+    def _convert_with (self, hf):
+        """Converts every field with the formatter *hf*."""
+        conversions = list()
+        for field in self._fields:
+            parsed = self._parse(hf, field, conversions)
+            conversions.append(self._convert_field(hf, field, parsed))
+        return conversions
+
+
+    def _convert_tree (self, hf, index, conversions):
+        """Converts a field, after its nested ones, into *conversions*."""
+        field = self._fields[index]
+        for piece in field['pieces']:
+            if isinstance(piece, int):
+                self._convert_tree(hf, piece, conversions)
+        parsed = self._parse(hf, field, conversions)
+        conversions[index] = self._convert_field(hf, field, parsed)
+
+
+    @staticmethod
+    def _convert_field (hf, field, parsed):
+        """Converts a parsed field, using its memo if it has one."""
+        spec = field['spec'] or _field_spec(parsed[1])
+        final_expr = Template._evaluate(hf, field, parsed[0])
+        return Template._apply_field(hf, field, spec, final_expr)
+
+
+    @staticmethod
+    def _apply_field (hf, field, spec, final_expr):
+        """Applies the spec to the field value, using the memo if it has one."""
+        memo = field['memo']
+        if memo is None:
+            return spec.format(final_expr, hf._measurer())
+        key = memo.key(final_expr, spec)
+        conversion = memo.get(key)
+        if conversion is None:
+            conversion = spec.format(final_expr, hf._measurer())
+            memo.put(key, conversion)
+        return conversion
+
+
+    def _depths (self):
+        """Returns the nesting level of each field, being 1 the top level."""
+        depths = [0] * len(self._fields)
+        for piece in self._pieces:
+            if isinstance(piece, int):
+                depths[piece] = 1
+        for index in reversed(range(len(self._fields))):
+            for piece in self._fields[index]['pieces']:
+                if isinstance(piece, int):
+                    depths[piece] = depths[index] + 1
+        return depths
+
+
+    def _levels (self):
+        """Returns the lists of fields indexes of each level, deepest first.
+
+        Fields are in that order already, so the lists are consecutive.
+
+        """
+        depths = self._depths()
+        levels = list()
+        for index, depth in enumerate(depths):
+            if not levels or depths[levels[-1][-1]] != depth:
+                levels.append(list())
+            levels[-1].append(index)
+        return levels
+
+
+    def _level_jobs (self, hf, level, conversions):
+        """Parses the fields of a level, before evaluating them together.
+
+        Returns a tuple (parsed, jobs). *parsed* has a tuple (parsed field,
+        spec) for each field, or the error raised getting it. *jobs* maps the
+        key of each value to evaluate (the field index, or its expression, if
+        shared) to its expression.
+
+        """
+        parsed = list()
+        jobs = OrderedDict()
+        for index in level:
+            field = self._fields[index]
+            try:
+                field_parsed = self._parse(hf, field, conversions)
+                spec = field['spec'] or _field_spec(field_parsed[1])
+            except Exception as err:
+                parsed.append(err)
+                continue
+            parsed.append((field_parsed, spec))
+            key = self._job_key(index, field)
+            if key not in jobs and (field['shared'] is None
+                                    or key not in hf._shared_values):
+                jobs[key] = field_parsed[0]
+        return parsed, jobs
+
+
+    def _level_conversions (self, hf, level, parsed, results, conversions):
+        """Converts the fields of a level, given the *results* of its jobs.
+
+        Each result is a tuple (value, error). The first error, in the fields
+        order, is raised.
+
+        """
+        for index, field_parsed in zip(level, parsed):
+            if isinstance(field_parsed, Exception):
+                raise field_parsed
+            field = self._fields[index]
+            key = self._job_key(index, field)
+            if field['shared'] is not None and key in hf._shared_values:
+                final_expr = hf._shared_values[key]
+            else:
+                final_expr, error = results[key]
+                if error is not None:
+                    raise error
+                if field['shared'] is not None:
+                    hf._shared_values[key] = final_expr
+            conversions[index] = self._apply_field(hf, field, field_parsed[1],
+                                                   final_expr)
+
+
+    @staticmethod
+    def _job_key (index, field):
+        """Returns the key of the value of a field, in its level jobs."""
+        return index if field['shared'] is None else field['shared']
+
+
+    @staticmethod
+    def _evaluate_job (hf, expression):
+        """Evaluates an expression, returning a tuple (value, error)."""
+        try:
+            return (hf.evaluate(expression), None)
+        except Exception as err:
+            return (None, err)
+
+
+    def _output (self, conversions):
+        """Joins the literal text and the conversions into the final output."""
+        final = self._join(self._pieces, conversions)
+        if self.encoding:
+            return final.encode(self.encoding)
+        return final
+
+
+    def _prepare (self, hf):
+        """Finds the shared expressions and the names, once fields are set."""
+        # Expressions known now that appear in more than one field are marked
+        # as shared, so they are evaluated once per formatting.
+        self._has_shared = False
+        if self.share_expressions:
+            counts = dict()
+            for field in self._fields:
+                expression = self._known_expression(hf, field)
+                if expression is not None:
+                    field['shared'] = expression
+                    counts[expression] = counts.get(expression, 0) + 1
+            for field in self._fields:
+                if counts.get(field['shared'], 0) > 1:
+                    self._has_shared = True
+                else:
+                    field['shared'] = None
+
+        # Names read by the expressions known now.
+        names = set()
+        for field in self._fields:
+            expression = self._known_expression(hf, field)
+            if expression is not None:
+                names.update(_expression_names(expression))
+        names.discard('__args__')
+        self.builtin_names = frozenset([name for name in names
+                                        if hasattr(builtins, name)])
+        self.names = frozenset(names - self.builtin_names)
+
+        self._encoded_pieces = None
+        if self.encoding:
+            self._encoded_pieces = [p if isinstance(p, int)
+                                    else p.encode(self.encoding)
+                                    for p in self._pieces]
+
+
+    @staticmethod
+    def _fold (pieces, conversions, new_indexes):
+        """Replaces the folded fields in *pieces* with their conversions."""
+        folded = list()
+        for piece in pieces:
+            if isinstance(piece, int):
+                if conversions[piece] is None:
+                    folded.append(new_indexes[piece])
+                    continue
+                piece = conversions[piece]
+            if folded and not isinstance(folded[-1], int):
+                folded[-1] += piece
+            elif piece:
+                folded.append(piece)
+        return folded
+
+
+    @staticmethod
+    def _foldable (expression, fixed):
+        """Tells if the expression only reads fixed arguments."""
+        if _POSITIONAL_REGEX.search(expression):
+            return False
+        try:
+            ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            return False
+        return all(name in fixed for name in _expression_names(expression))
+
+
+    @staticmethod
+    def _evaluate (hf, field, expression):
+        """Evaluates the expression, sharing its value if it is shared."""
+        if field['shared'] is None:
+            return hf.evaluate(expression)
+        values = hf._shared_values
+        if field['shared'] in values:
+            return values[field['shared']]
+        value = values[field['shared']] = hf.evaluate(expression)
+        return value
+
+
+    @staticmethod
+    def _known_expression (hf, field):
+        """Returns the normalized field expression, or None if not known yet."""
+        if field['parsed'] is not None:
+            expression = field['parsed'][0]
+        elif field['auto'] is not None:
+            expression = '_{}_'.format(field['auto'])
+        elif field['skeleton'] is not None \
+             and all(not isinstance(p, int) for p in field['skeleton'][0]):
+            expression = ''.join(field['skeleton'][0])
+        else:
+            return None
+        return hf._normalize(expression)
+
+
+    @staticmethod
+    def _numbered (field, parsed):
+        """Replaces an empty expression with its positional argument."""
+        if field['auto'] is None:
+            return parsed
+        return ('_{}_'.format(field['auto']), parsed[1])
+
+
+    @staticmethod
+    def _split (token, indexes):
+        """Splits the token into literals and the indexes of its childs."""
+        pieces = list()
+        start = 0
+        for child in token.childs:
+            key = '{' + child.token + '}'
+            position = token.token.find(key, start)
+            if position > start:
+                pieces.append(token.token[start:position])
+            pieces.append(indexes[id(child)])
+            start = position + len(key)
+        if start < len(token.token):
+            pieces.append(token.token[start:])
+        return pieces
+
+
+    @staticmethod
+    def _join (pieces, conversions):
+        """Joins the pieces, replacing the indexes with their conversion."""
+        return ''.join([conversions[p] if isinstance(p, int) else p
+                        for p in pieces])
+
+
+
+class BoundTemplate (object):
+    """BoundTemplate Class
+
+    Stateful wrapper of a *Template* for outputs that are formatted again and
+    again with slightly different arguments, such as live progress lines. It
+    keeps the last conversion of every field along with the values of the
+    names its expression used; and each new formatting only converts again
+    the fields whose values changed, or whose nested fields changed. If no
+    field changed at all, the last output is returned as is.
+
+    Values are compared by type and with '==' (floats and decimals also by
+    sign and exponent), so 1, 1.0 and True are different values. Objects
+    changed in place (such as a list that gets a new item) compare equal to
+    themselves, so 'invalidate()' must be called after modifying them.
+
+    Public attributes:
+        template (Template): Bound template.
+
+    Methods:
+        format() -> str: Same as 'Template.format()', but reusing the fields
+            conversions that are still valid.
+        invalidate() -> None: Forgets every conversion, so the next formatting
+            converts all the fields.
+
+    """
+    def __init__ (self, template):
+        self.template = template
+        self.invalidate()
+
+
+    def invalidate (self):
+        """Forgets all the kept conversions."""
+        self._states = [None] * len(self.template._fields)
+        self._conversions = [None] * len(self.template._fields)
+        self._output = None
+
+
+    def format (self__, *args, **kwargs):
+        """Returns the template formatted, converting only what changed."""
+        template = self__.template
+        hf = template._formatter(args, kwargs)
+        # Work on copies, so a field that raises keeps the last state intact.
+        states = list(self__._states)
+        conversions = list(self__._conversions)
+        changed = [False] * len(conversions)
+        for index, field in enumerate(template._fields):
+            state = states[index]
+            nested_changed = any(changed[p] for p in field['pieces']
+                                 if isinstance(p, int))
+            if state is not None and not nested_changed:
+                expression, fake_expr, values = state
+                if hf._translate(expression) == fake_expr \
+                   and self__._same(values, self__._values(hf, fake_expr)):
+                    continue
+            parsed = template._parse(hf, field, conversions)
+            expression = hf._normalize(parsed[0])
+            fake_expr = hf._translate(expression)
+            conversion = template._convert_field(hf, field, parsed)
+            states[index] = (expression, fake_expr,
+                             self__._values(hf, fake_expr))
+            changed[index] = conversion != conversions[index]
+            conversions[index] = conversion
+
+        if self__._output is None or any(changed):
+            output = template._output(conversions)
+        else:
+            output = self__._output
+        self__._states = states
+        self__._conversions = conversions
+        self__._output = output
+        return output
+
+
+    def _values (self, hf, fake_expr):
+        """Returns the current values of the names used by the expression."""
+        names = _expression_names(fake_expr)
+        given_args = hf.given_args
+        return tuple([self._value_key(given_args.get(name, _MISSING))
+                      for name in names])
+
+
+    @staticmethod
+    def _value_key (value):
+        """Returns what tells if *value* is formatted as a previous one."""
+        kind = type(value)
+        if kind is float:
+            # 0.0 and -0.0 are equal, but they are not formatted the same.
+            return (kind, value, math.copysign(1.0, value))
+        if kind is Decimal:
+            # So are Decimal('1.0') and Decimal('1.00').
+            return (kind, value, value.as_tuple())
+        return (kind, value)
+
+
+    @staticmethod
+    def _same (old_values, new_values):
+        """Tells if both values tuples are equal, or False if unknown."""
+        try:
+            return bool(old_values == new_values)
+        except Exception:
+            return False
+
+
+
+class ResultMemo (object):
+    """ResultMemo Class
+
+    Bounded cache of conversions for a template field. Each conversion is
+    stored with the evaluated value and the field functions as key, so the
+    whole specification (fill, canvas, wrap...) is skipped when the same value
+    is formatted again. When the memo is full, the least recently used
+    conversion is discarded.
+
+    Only values of immutable built-in types (and enumerations) are memoized,
+    as the conversion of any other object may change between calls. Those
+    values are counted as skipped. Custom functions are expected to always
+    return the same for the same value.
+
+    Public attributes:
+        size (int): Maximum number of conversions stored.
+        hits (int): Number of conversions found in the memo.
+        misses (int): Number of conversions not found in the memo.
+        skipped (int): Number of values that could not be memoized.
+
+    Methods:
+        key() -> tuple: Returns the memo key for a value and its FieldSpec,
+            or None if the value can not be memoized.
+        get() -> str: Returns the stored conversion for a key, or None.
+        put() -> None: Stores a conversion for a key.
+        stats() -> dict: Returns the memo statistics.
+        clear() -> None: Discards all the stored conversions.
+
+    """
+    def __init__ (self, size):
+        self.size = size
+        self.hits = self.misses = self.skipped = 0
+        self._cache = OrderedDict()
+
+
+    def key (self, value, spec):
+        """Returns the key for *value* formatted with the FieldSpec *spec*."""
+        kind = type(value)
+        if kind not in _MEMO_TYPES and not (Enum and isinstance(value, Enum)):
+            return None
+        spec = spec.key
+        if kind is float:
+            if value != value:
+                return None     # NaN is never equal to itself.
+            # 0.0 and -0.0 are equal, but they are not formatted the same.
+            return (kind, value, math.copysign(1.0, value), spec)
+        return (kind, value, spec)
+
+
+    def get (self, key):
+        """Returns the conversion stored for *key*, or None."""
+        if key is None:
+            self.skipped += 1
+            return None
+        try:
+            conversion = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        # Most recently used goes last.
+        if hasattr(self._cache, 'move_to_end'):
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = self._cache.pop(key)
+        self.hits += 1
+        return conversion
+
+
+    def put (self, key, conversion):
+        """Stores *conversion* for *key*, discarding the oldest if full."""
+        if key is None:
+            return
+        self._cache[key] = conversion
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+
+    def stats (self):
+        """Returns a dict with the memo statistics."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'skipped': self.skipped,
+                'size': len(self._cache),
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+
+    def clear (self):
+        """Discards all the stored conversions and resets the statistics."""
+        self._cache.clear()
+        self.hits = self.misses = self.skipped = 0
+
+
+    def __getstate__ (self):
+        """Conversions are not pickled, only the memo size."""
+        return {'size': self.size}
+
+
+    def __setstate__ (self, state):
+        self.__init__(state['size'])
+
+
+
 class FunctionObject (object):
     """FunctionObject Class
 
@@ -532,9 +2468,16 @@ class FunctionObject (object):
             Note that all the arguments defined for the function will be stored,
             even the ones that the user gave no value. Those will have 'None' as
             their value.
+        key (tuple): Hashable (name, args) pair that identifies the function
+            along with the given arguments.
+
+    Methods:
+        rebuild() -> FunctionObject: Returns a copy of the object with other
+            arguments, skipping all the checks.
 
     Private methods:
         _build() -> None: Actually creates the object.
+        _map_args() -> None: Maps the given arguments to the 'args' dict.
 
     Raises:
         NameError: If it does not find a given function name in the defs.
@@ -550,17 +2493,12 @@ class FunctionObject (object):
         self._build(name, args)
 
 
-    def _build (self, given_name, given_args):
-        """Builds the object.
-
-        Takes the given function name and its arguments, searches for them in
-        the functions definitions (YAML) and if everything is correct, the
-        object is created. Else, it would raise an error.
-
-        """
-        if FunctionObject._fdefs is None:
+    @classmethod
+    def _definitions (cls):
+        """Returns the functions definitions dict, loading it if needed."""
+        if cls._fdefs is None:
             # Functions definitions dict is created from YAML just once.
-            FunctionObject._fdefs = dict()
+            cls._fdefs = dict()
             if sys.version_info[0] < 3:
                 raw_def = yaml.load(open(_FDEFS_FILE))
             else:
@@ -581,14 +2519,24 @@ class FunctionObject (object):
                     allowed_names = [n.strip() for n in raw_name.split(',')]
                     main_name = allowed_names[0]
                     for func_name in allowed_names:
-                        FunctionObject._fdefs[func_name] = {
+                        cls._fdefs[func_name] = {
                             'id': main_name,
                             'args': args
                         }
+        return cls._fdefs
+
+
+    def _build (self, given_name, given_args):
+        """Builds the object.
+
+        Takes the given function name and its arguments, searches for them in
+        the functions definitions (YAML) and if everything is correct, the
+        object is created. Else, it would raise an error.
 
+        """
         # Building the object
         try:
-            func_def = FunctionObject._fdefs[given_name]
+            func_def = FunctionObject._definitions()[given_name]
         except KeyError:
             raise NameError(ERR_FUNC_DOESNT_EXIST.format(given_name))
 
@@ -609,15 +2557,36 @@ class FunctionObject (object):
                                                     min_man_args,
                                                     n_given_args))
         # If success, the given arguments are mapped to their definition args.
+        self._args_names = [def_arg[0] for def_arg in func_def['args']]
+        self._map_args(given_args)
+
+
+    def _map_args (self, given_args):
+        """Maps the given arguments to their names and positions."""
+        self.key = (self.name, tuple(given_args))
         self.args = dict()
-        for index, combo in enumerate(zip_longest(func_def['args'], given_args)):
+        for index, combo in enumerate(zip_longest(self._args_names, given_args)):
             # Arguments are stored in the dict both with their position and
             # their definition name.
-            def_arg, given_arg = combo
-            self.args[def_arg[0]] = given_arg
+            arg_name, given_arg = combo
+            self.args[arg_name] = given_arg
             self.args[index] = given_arg
 
 
+    def rebuild (self, given_args):
+        """Returns a copy of this object with other arguments.
+
+        The new arguments must be as many as the current ones, so they are
+        not checked again.
+
+        """
+        fobj = object.__new__(FunctionObject)
+        fobj.name = self.name
+        fobj._args_names = self._args_names
+        fobj._map_args(given_args)
+        return fobj
+
+
     def __str__ (self):
         """For debug printing"""
         out = "Function Name: {}\n".format(self.name)
@@ -626,3 +2595,9 @@ class FunctionObject (object):
             if not isinstance(key, int):
                 out += " - {0}: {1}\n".format(key, value)
         return out
+
+
+if __name__ == '__main__':
+    # 'python -m hformat' formats streams of records (see 'cli.py').
+    from cli import main
+    sys.exit(main())
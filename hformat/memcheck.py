@@ -0,0 +1,183 @@
+#!python
+#-*- coding: utf-8 -*-
+"""
+    Memory Budgets Checker for Human Formatter
+
+    This script measures, with 'tracemalloc', the memory used by formatting a
+    set of representative templates (simple, wide, deeply nested and canvas
+    or multichar filling heavy) in every mode: plain 'hformat()', compiled
+    templates, batch ('format_many()'), streaming (the command line chunks),
+    and cached (memoized and bound templates).
+
+    For each case, three figures are taken:
+        peak: Highest memory (bytes) allocated during a single formatting,
+            over the memory in use before it.
+        blocks: Memory blocks allocated by a single formatting and still in
+            use when it returns (its output, and anything it keeps), taken
+            from the snapshots before and after it.
+        retained: Memory blocks still allocated after many formattings, over
+            the ones allocated after the first one. Anything but zero means
+            that something grows with every formatting.
+
+    All of them are checked against the budgets stored in 'membudgets.yml', and the
+    script exits with status 1 if any of them is exceeded:
+
+        python memcheck.py            # Checks the budgets.
+        python memcheck.py --update   # Measures and stores new budgets.
+
+    Functions
+    ---------
+    measure() -> dict
+        Returns the figures of a single case.
+
+    main() -> int
+        Measures every case, checks (or updates) the budgets and returns the
+        exit status.
+
+
+    Created:        18 Oct 2026
+    Last modified:  18 Oct 2026
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+import yaml
+
+import cli
+from hformat import hformat, hfcompile
+
+
+#
+# Definitions
+#
+_BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "membudgets.yml")
+_REPEAT = 200
+_MARGIN = 1.25          # Budgets updated with 25% over the measured peak,
+_BLOCKS_MARGIN = 4      # and blocks (plus a few, as small counts vary),
+_RETAINED_MARGIN = 16   # and with some blocks over the measured retained.
+_BLOCKS_SAMPLES = 10    # Formattings whose blocks are counted.
+
+_TEMPLATES = {
+    'simple': ("Total: {total : milesep, float(2)} {unit}",
+               dict(total=12345.678, unit='EUR')),
+    'wide': (' | '.join("{{c{0} : field(8, ., right)}}".format(i)
+                        for i in range(30)),
+             dict(("c{}".format(i), i * 7) for i in range(30))),
+    'nested': ("{value : width({w}), float({p})} {name : field({w}, {f},"
+               " {a})} {value : canvas(+{pad}, <.>, center), float({p})}",
+               dict(value=3.14159, w=12, p=3, name='pi', f='-', a='right',
+                    pad=4)),
+    'fill': ("{a : canvas(40, '[]', center)} {b : fill(-=+), width(40),"
+             " right} {c : canvas(+20, <*>, center), wrap('()')}",
+             dict(a='canvas', b='multifill', c='both')),
+}
+
+
+#
+# Functions
+#
+def _cases ():
+    """Yields (name, render) for every template and mode."""
+    for name, (template, kwargs) in sorted(_TEMPLATES.items()):
+        compiled = hfcompile(template)
+        memoized = hfcompile(template, memo_size=64)
+        bound = compiled.bind()
+        records = [dict(kwargs) for _ in range(10)]
+        cli._init_worker(template, '\n', False)
+        chunk = [(i, ('kwargs', record)) for i, record in enumerate(records)]
+
+        yield name + '/hformat', lambda t=template, k=kwargs: hformat(t, **k)
+        yield name + '/template', lambda c=compiled, k=kwargs: c.format(**k)
+        yield name + '/batch', lambda c=compiled, r=records: c.format_many(r)
+        yield name + '/stream', lambda c=chunk: cli._format_chunk(c)
+        yield name + '/memo', lambda c=memoized, k=kwargs: c.format(**k)
+        yield name + '/bound', lambda b=bound, k=kwargs: b.format(**k)
+
+
+def measure (render, repeat=_REPEAT):
+    """Returns the peak, blocks and retained figures of *render* (see above).
+    """
+    render()    # Compiling, caching and so are not measured.
+    gc.collect()
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    blocks = 0
+    for _ in range(_BLOCKS_SAMPLES):
+        before = _traced_snapshot()
+        result = render()
+        blocks = max(blocks, sum(stat.count_diff for stat in
+                                 _traced_snapshot().compare_to(before,
+                                                               'filename')
+                                 if stat.count_diff > 0))
+        del result
+    peak = 0
+    for _ in range(repeat):
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = render()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        del result
+    gc.collect()
+    retained = 0
+    for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'filename'):
+        if stat.traceback[0].filename.startswith(os.path.dirname(
+                                                _BUDGETS_FILE)):
+            retained += stat.count_diff
+    tracemalloc.stop()
+    return {'peak': peak, 'blocks': blocks, 'retained': max(retained, 0)}
+
+
+def _traced_snapshot ():
+    """Returns a snapshot without the blocks of 'tracemalloc' itself."""
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def main (argv=None):
+    """Checks or updates the memory budgets. Returns the exit status."""
+    argv = sys.argv[1:] if argv is None else argv
+    update = '--update' in argv
+    budgets = dict()
+    if not update:
+        with open(_BUDGETS_FILE) as budgets_file:
+            budgets = yaml.safe_load(budgets_file) or dict()
+
+    status = 0
+    new_budgets = dict()
+    for name, render in _cases():
+        figures = measure(render)
+        if update:
+            new_budgets[name] = {
+                'peak': int(figures['peak'] * _MARGIN),
+                'blocks': int(figures['blocks'] * _MARGIN) + _BLOCKS_MARGIN,
+                'retained': figures['retained'] + _RETAINED_MARGIN,
+            }
+            verdict = 'stored'
+        elif not set(figures) <= set(budgets.get(name, ())):
+            verdict = 'NO BUDGET'
+            status = 1
+        else:
+            exceeded = [key for key, value in figures.items()
+                        if value > budgets[name][key]]
+            verdict = 'EXCEEDED ' + ', '.join(exceeded) if exceeded else 'ok'
+            if exceeded:
+                status = 1
+        print("{0:<18} peak {1[peak]:>8} B  blocks {1[blocks]:>4}  retained"
+              " {1[retained]:>4} blocks  {2}".format(name, figures, verdict))
+
+    if update:
+        with open(_BUDGETS_FILE, 'w') as budgets_file:
+            budgets_file.write("# Memory budgets per formatting, checked by"
+                               " 'memcheck.py'.\n")
+            budgets_file.write("# Regenerate with 'python memcheck.py"
+                               " --update'.\n")
+            yaml.safe_dump(new_budgets, budgets_file, default_flow_style=False)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!python
+#-*- coding: utf-8 -*-
+"""
+    Display Width for Human Formatter
+
+    This module measures strings as terminals show them, in cells, instead of
+    counting chars: East Asian wide and fullwidth chars (CJK ideographs, most
+    emoji...) take two cells, while combining marks and other zero width chars
+    take none.
+
+    The width of each char is obtained from the Unicode database just once,
+    and then kept; and pure ASCII strings are measured with no lookup at all.
+
+    Functions
+    ---------
+    display_width() -> int
+        Returns the number of cells a string takes.
+
+    char_width() -> int
+        Returns the number of cells a single char takes (0, 1 or 2).
+
+
+    Created:        18 Oct 2026
+    Last modified:  18 Oct 2026
+"""
+import sys
+import unicodedata
+
+#
+# Definitions
+#
+_WIDE = ('W', 'F')                      # East Asian width properties.
+_ZERO_WIDTH_CATEGORIES = ('Mn', 'Me', 'Cf')
+_widths = dict()                        # Width of each char already seen.
+
+
+#
+# Functions
+#
+def char_width (char):
+    """Returns the number of cells *char* takes."""
+    width = _widths.get(char)
+    if width is None:
+        if unicodedata.category(char) in _ZERO_WIDTH_CATEGORIES:
+            width = 0
+        elif unicodedata.east_asian_width(char) in _WIDE:
+            width = 2
+        else:
+            width = 1
+        _widths[char] = width
+    return width
+
+
+if sys.version_info >= (3, 7):
+    def _isascii (string):
+        return string.isascii()
+else:
+    def _isascii (string):
+        try:
+            string.encode('ascii')
+        except (UnicodeError, AttributeError):
+            return False
+        return True
+
+
+def display_width (string):
+    """Returns the number of cells *string* takes in a terminal."""
+    if _isascii(string):
+        return len(string)
+    widths = _widths
+    width = 0
+    for char in string:
+        char_cells = widths.get(char)
+        if char_cells is None:
+            char_cells = char_width(char)
+        width += char_cells
+    return width